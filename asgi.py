@@ -0,0 +1,8 @@
+"""ASGI entry point, e.g. uvicorn asgi:app."""
+# asgi.py
+from movie_web_app import create_app
+from movie_web_app.asgi import AsgiAdapter
+
+flask_app = create_app()
+
+app = AsgiAdapter(flask_app, max_workers=flask_app.config['ASGI_WORKERS'])
@@ -12,7 +12,41 @@ class Config:
 
     # Database configuration
     SQLALCHEMY_DATABASE_URI = environ.get('SQLALCHEMY_DATABASE_URI')
-    SQLALCHEMY_ECHO = True
+    SQLALCHEMY_ECHO = environ.get('SQLALCHEMY_ECHO') == 'True'
+    # Connection pool: 'queue' (reuse up to SQLALCHEMY_POOL_SIZE connections), 'static' or 'null'.
+    SQLALCHEMY_POOL = environ.get('SQLALCHEMY_POOL', 'queue')
+    SQLALCHEMY_POOL_SIZE = int(environ.get('SQLALCHEMY_POOL_SIZE', 5))
+    # PRAGMAs applied to each SQLite connection: 'tuned' (WAL, mmap, larger cache) or 'default'.
+    SQLITE_PROFILE = environ.get('SQLITE_PROFILE', 'tuned')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Wipe and repopulate the database, users and reviews included, on every start, even if it is already built
+    # from the current CSV.
+    REBUILD_DATABASE = environ.get('REBUILD_DATABASE') == 'True'
 
-    REPOSITORY = environ.get('REPOSITORY')
\ No newline at end of file
+    # Queue reviews and write them in one transaction per REVIEW_BATCH_SIZE reviews, or every
+    # REVIEW_BATCH_DELAY seconds, instead of one transaction each.
+    REVIEW_WRITE_BEHIND = environ.get('REVIEW_WRITE_BEHIND') == 'True'
+    REVIEW_BATCH_SIZE = int(environ.get('REVIEW_BATCH_SIZE', 50))
+    REVIEW_BATCH_DELAY = float(environ.get('REVIEW_BATCH_DELAY', 0.5))
+
+    REPOSITORY = environ.get('REPOSITORY')
+
+    # Rendered /display pages kept in memory, least recently used dropped first (0 disables the cache).
+    PAGE_CACHE_SIZE = int(environ.get('PAGE_CACHE_SIZE', 256))
+
+    # Rendered movie cards kept in memory, least recently used dropped first (0 disables the cache).
+    FRAGMENT_CACHE_SIZE = int(environ.get('FRAGMENT_CACHE_SIZE', 2048))
+
+    # Compiled templates are kept in this directory, shared by every process using it. Unset, Jinja's default
+    # directory in the system temporary directory is used; set it to an empty string to compile in memory only.
+    TEMPLATE_BYTECODE_CACHE_DIR = environ.get('TEMPLATE_BYTECODE_CACHE_DIR')
+
+    # /display pages: the largest per_page accepted, and the page size above which pages are streamed.
+    MAX_PAGE_SIZE = int(environ.get('MAX_PAGE_SIZE', 1000))
+    STREAM_PAGE_SIZE = int(environ.get('STREAM_PAGE_SIZE', 50))
+
+    # Memory repository: parsed-CSV snapshot used for fast startup (disabled when unset).
+    MEMORY_SNAPSHOT_PATH = environ.get('MEMORY_SNAPSHOT_PATH')
+
+    # ASGI entry point (asgi.py): worker threads running Flask views; further requests wait on the event loop.
+    ASGI_WORKERS = int(environ.get('ASGI_WORKERS', 8))
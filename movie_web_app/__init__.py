@@ -1,13 +1,17 @@
 # __init__.py
 from flask import Flask, request, session
+from jinja2 import FileSystemBytecodeCache
+import atexit
 import os
-from movie_web_app.adapters.memory_repository import MemoryRepository, read_csv_file
+from movie_web_app.adapters.memory_repository import MemoryRepository, load_movies
 import movie_web_app.adapters.repository as repo
 from movie_web_app.adapters import memory_repository, database_repository
+from movie_web_app.adapters.write_behind import ReviewWriteBehind
+from movie_web_app.movies.page_cache import PageCache
+from movie_web_app.movies.fragment_cache import FragmentCache
+from movie_web_app.movies.conditional import etag_seed
 
-from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, clear_mappers
-from sqlalchemy.pool import NullPool
 from movie_web_app.adapters.orm import metadata, map_model_to_tables
 
 def create_app(test_config=None):
@@ -27,32 +31,105 @@ def create_app(test_config=None):
 
     if app.config['REPOSITORY'] == 'memory':
         repo.repo_instance = MemoryRepository()
-        read_csv_file(data_path,repo.repo_instance)
+        load_movies(data_path, repo.repo_instance, app.config.get('MEMORY_SNAPSHOT_PATH'))
+        # Reviews live in this process only, so page ETags are too.
+        app.config['ETAG_SEED'] = etag_seed()
 
     elif app.config['REPOSITORY'] == 'database':
         # Configure database.
         database_uri = app.config['SQLALCHEMY_DATABASE_URI']
-
-        database_echo = app.config['SQLALCHEMY_ECHO']
-        database_engine = create_engine(database_uri, connect_args={"check_same_thread": False}, poolclass=NullPool,
-                                        echo=database_echo)
-
-        if app.config['TESTING'] == True or len(database_engine.table_names()) == 0:
+        # SQLite allows one writer at a time, so all writes share a single pooled connection.
+        database_engine = database_repository.create_database_engine(
+            database_uri,
+            pool=app.config['SQLALCHEMY_POOL'],
+            pool_size=1,
+            max_overflow=0,
+            echo=app.config['SQLALCHEMY_ECHO'],
+            profile=app.config['SQLITE_PROFILE'])
+
+        if database_repository.migrate_legacy_schema(database_engine):
+            print("MIGRATED DATABASE TO NORMALIZED SCHEMA")
+            # The migrated rows came from the CSV in use before, so treat it as built from the current one.
+            metadata.create_all(database_engine)
+            database_repository.rebuild_review_aggregates(database_engine)
+            with database_engine.begin() as connection:
+                database_repository.build_search_index(connection)
+            database_repository.record_database_build(database_engine, data_path)
+
+        clear_mappers()
+        if app.config['REBUILD_DATABASE']:
+            # Asked for explicitly: start over, dropping the users and reviews with everything else.
             print("REPOPULATING DATABASE")
-            clear_mappers()
+            metadata.drop_all(database_engine)
             metadata.create_all(database_engine)
-            for table in reversed(metadata.sorted_tables):
-                database_engine.execute(table.delete())
-
-            map_model_to_tables()
-
-            database_repository.populate(database_engine, data_path)
+            report = database_repository.populate(database_engine, data_path)
+            database_repository.record_database_build(database_engine, data_path)
+            print("POPULATED DATABASE: {} rows in {:.2f}s ({:.0f} rows/s)".format(
+                report.rows, report.seconds, report.rows_per_second))
 
         else:
-            map_model_to_tables()
+            # Tables, columns and indexes added since the database was built are added in place.
+            migrated = database_repository.migrate_schema(database_engine)
+            if migrated:
+                print("MIGRATED DATABASE: {}".format(', '.join(sorted(migrated))))
+            catalog_tables = {table.name for table in database_repository.CATALOG_TABLES}
+            if not database_repository.database_is_current(database_engine, data_path) or migrated & catalog_tables:
+                # A new CSV, or catalog tables that need filling: reload the movies, keeping the users and
+                # their reviews.
+                print("REPOPULATING MOVIE CATALOG")
+                report = database_repository.rebuild_catalog(database_engine, data_path)
+                print("POPULATED DATABASE: {} rows in {:.2f}s ({:.0f} rows/s)".format(
+                    report.rows, report.seconds, report.rows_per_second))
+
+            else:
+                # Already built from this CSV: open it as it is, without reading the CSV.
+                database_repository.optimize_database(database_engine)
+        map_model_to_tables()
+
+        # Processes sharing the database share page ETags, until it is rebuilt.
+        app.config['ETAG_SEED'] = etag_seed(database_repository.read_schema_info(database_engine).get('build'))
 
         session_factory = sessionmaker(autocommit=False, autoflush=True, bind=database_engine)
-        repo.repo_instance = database_repository.SqlAlchemyRepository(session_factory)
+        read_session_factory = None
+        if not database_repository.is_in_memory_database(database_uri):
+            # Reads get their own pool of read-only connections. Their sessions never flush: views set
+            # display-only attributes such as add_comment_url on the objects they load.
+            read_engine = database_repository.create_database_engine(
+                database_uri,
+                pool=app.config['SQLALCHEMY_POOL'],
+                pool_size=app.config['SQLALCHEMY_POOL_SIZE'],
+                echo=app.config['SQLALCHEMY_ECHO'],
+                profile=app.config['SQLITE_PROFILE'],
+                read_only=True)
+            read_session_factory = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+        review_writer = None
+        if app.config['REVIEW_WRITE_BEHIND']:
+            review_writer = ReviewWriteBehind(session_factory,
+                                              batch_size=app.config['REVIEW_BATCH_SIZE'],
+                                              max_delay=app.config['REVIEW_BATCH_DELAY'])
+            # Reviews still queued when the process exits are written before it does.
+            atexit.register(review_writer.close)
+        repo.repo_instance = database_repository.SqlAlchemyRepository(
+            session_factory, read_session_factory, review_writer)
+
+    if app.config['PAGE_CACHE_SIZE'] > 0:
+        page_cache = PageCache(app.config['PAGE_CACHE_SIZE'])
+        app.extensions['page_cache'] = page_cache
+        # Listing pages show movie reviews, so a review drops the cached pages showing its movie.
+        repo.repo_instance.review_listeners.append(
+            lambda subjects: page_cache.invalidate_titles({name for kind, name in subjects if kind == 'movie'}))
+
+    if app.config['FRAGMENT_CACHE_SIZE'] > 0:
+        # Cards are keyed by the version of the movie they show, so reviews need no listener here.
+        app.extensions['fragment_cache'] = FragmentCache(app.config['FRAGMENT_CACHE_SIZE'])
+
+    if app.config['TEMPLATE_BYTECODE_CACHE_DIR'] != '':
+        # Templates are compiled once per source change instead of once per process. Entries are keyed by a
+        # checksum of the template source, so an edited template is never served from an outdated entry.
+        bytecode_cache_dir = app.config['TEMPLATE_BYTECODE_CACHE_DIR']
+        if bytecode_cache_dir is not None:
+            os.makedirs(bytecode_cache_dir, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(bytecode_cache_dir)
 
     with app.app_context():
         # Register blueprints.
@@ -68,10 +145,20 @@ def create_app(test_config=None):
         from .authentication import authentication
         app.register_blueprint(authentication.authentication_blueprint)
 
+        from .api import api
+        app.register_blueprint(api.api_blueprint)
+
         @app.before_request
         def before_flask_http_request_function():
             if isinstance(repo.repo_instance, database_repository.SqlAlchemyRepository):
                 repo.repo_instance.reset_session()
+                # Users see their own reviews on their next page, even if the batch they are in is not due.
+                # A batch that fails stays queued for the background flush, so the page is served regardless.
+                if 'username' in session:
+                    try:
+                        repo.repo_instance.flush_reviews(session['username'])
+                    except Exception as error:
+                        print("REVIEW WRITE-BEHIND FLUSH FAILED: {}".format(error))
 
         @app.teardown_appcontext
         def shutdown_session(exception=None):
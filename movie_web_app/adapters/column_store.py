@@ -0,0 +1,104 @@
+# column_store.py
+import numpy as np
+
+
+# Numeric movie attributes, named as on Movie, and the dtype of the column holding each one.
+# Revenue and Metascore are missing ('N/A') for some movies and are stored as NaN.
+MOVIE_COLUMNS = {
+    'time': np.int32,
+    'rating': np.float64,
+    'runtime_minutes': np.int32,
+    'revenue': np.float64,
+    'meta': np.float64,
+    'vote': np.int64,
+}
+
+
+class MovieColumnStore:
+    # Holds the numeric attributes of every movie as typed NumPy arrays, one row per movie,
+    # so that range filters, sorts and top-N queries are vectorised instead of looping over Movies.
+
+    def __init__(self, capacity=1024):
+        self._size = 0
+        self._ids = np.zeros(capacity, dtype=np.int64)
+        self._columns = {name: np.zeros(capacity, dtype=dtype) for name, dtype in MOVIE_COLUMNS.items()}
+
+    def __len__(self):
+        return self._size
+
+    def add(self, movie_id, time, rating, runtime_minutes, revenue, meta, vote):
+        if self._size == len(self._ids):
+            self._grow()
+        row = self._size
+        self._ids[row] = movie_id
+        self._columns['time'][row] = int(time)
+        self._columns['rating'][row] = float(rating)
+        self._columns['runtime_minutes'][row] = int(runtime_minutes)
+        self._columns['revenue'][row] = to_float(revenue)
+        self._columns['meta'][row] = to_float(meta)
+        self._columns['vote'][row] = int(vote)
+        self._size += 1
+
+    def column(self, name):
+        # Returns a read-only view of the named column, in the same row order as ids().
+        view = self._columns[name][:self._size]
+        view.flags.writeable = False
+        return view
+
+    def ids(self):
+        view = self._ids[:self._size]
+        view.flags.writeable = False
+        return view
+
+    def select(self, ranges=None, order_by=None, descending=False, limit=None):
+        # Returns the ids of the movies whose values fall inside every (low, high) range, both ends
+        # inclusive and None meaning unbounded. Movies with a missing value never match a range on it.
+        # Results are ordered by id, or by the order_by column with missing values last and ties broken
+        # by id, and cut to the first limit ids.
+        mask = np.ones(self._size, dtype=bool)
+        for name, (low, high) in (ranges or {}).items():
+            values = self._columns[name][:self._size]
+            if low is not None:
+                mask &= values >= low
+            if high is not None:
+                mask &= values <= high
+        rows = np.flatnonzero(mask)
+        ids = self._ids[rows]
+
+        if order_by is None:
+            ids = np.sort(ids)
+            if limit is not None:
+                ids = ids[:limit]
+            return ids.tolist()
+
+        keys = self._columns[order_by][rows].astype(np.float64)
+        if descending:
+            keys = -keys
+        keys[np.isnan(keys)] = np.inf
+
+        if limit is not None and limit < len(keys):
+            if limit <= 0:
+                return []
+            # Keep everything up to and including the limit-th smallest key, ties included,
+            # so the final ordering is the same as a full sort.
+            threshold = np.partition(keys, limit - 1)[limit - 1]
+            candidates = keys <= threshold
+            keys = keys[candidates]
+            ids = ids[candidates]
+
+        order = np.lexsort((ids, keys))
+        if limit is not None:
+            order = order[:limit]
+        return ids[order].tolist()
+
+    def _grow(self):
+        capacity = max(2 * len(self._ids), 1)
+        self._ids = np.resize(self._ids, capacity)
+        for name in self._columns:
+            self._columns[name] = np.resize(self._columns[name], capacity)
+
+
+def to_float(value):
+    if value is None or value == 'N/A' or value == '':
+        return np.nan
+    return float(value)
@@ -1,20 +1,30 @@
 # database_repository.py
-import csv
+import json
 import os
+import time
+import uuid
 
 from datetime import date
 from typing import List
+from urllib.request import pathname2url
 
-from sqlalchemy import desc, asc
+from sqlalchemy import desc, asc, select, union_all, cast, func, Float, inspect, create_engine, event, text, bindparam, DateTime
 from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.schema import CreateColumn, CreateIndex, CreateTable
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
+from sqlalchemy.pool import NullPool, QueuePool, StaticPool
 from werkzeug.security import generate_password_hash
 
-from sqlalchemy.orm import scoped_session
+from sqlalchemy.orm import scoped_session, selectinload
 from flask import _app_ctx_stack
 
-from movie_web_app.domain.model import Movie, Actor, Director, Genre, Review, User
-from movie_web_app.adapters.repository import AbstractRepository
+from movie_web_app.domain.model import Movie, Actor, Director, Genre, Review, ReviewAggregate, User
+from movie_web_app.adapters.repository import AbstractRepository, MOVIE_RELATIONSHIPS, NAME_KINDS
+from movie_web_app.adapters import orm
+from movie_web_app.adapters.memory_repository import movie_records
+from movie_web_app.adapters.snapshot import file_fingerprint, matches_source
+from movie_web_app.adapters.text_index import SEARCH_FIELDS, SEARCH_WEIGHTS, parse_query
 
 
 
@@ -40,50 +50,151 @@ class SessionContextManager:
         self.__session.rollback()
 
     def reset_session(self):
-        self.close_current_session()
-        self.__session = scoped_session(self.__session_factory, scopefunc=_app_ctx_stack.__ident_func__)
+        # The scoped_session registry lives as long as the repository; only the session it holds for the
+        # current app context is discarded, and a new one is made the next time it is used.
+        self.__session.remove()
 
     def close_current_session(self):
-        if not self.__session is None:
-            self.__session.close()
+        self.__session.remove()
+
+
+DATABASE_POOLS = {
+    'queue': QueuePool,
+    'static': StaticPool,
+    'null': NullPool,
+}
+
+# PRAGMAs applied to every new SQLite connection. 'tuned' uses WAL so readers are not blocked while a
+# review is being written, memory-mapped reads, a 64MB page cache and in-memory temporary tables.
+SQLITE_PROFILES = {
+    'default': {},
+    'tuned': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64 * 1024,
+        'temp_store': 'MEMORY',
+    },
+}
+
+
+def create_database_engine(database_uri: str, pool: str = 'queue', pool_size: int = 5, echo: bool = False,
+                           profile: str = 'tuned', read_only: bool = False, max_overflow: int = 10) -> Engine:
+    # 'queue' keeps up to pool_size open connections to a file database and hands them out to requests,
+    # opening up to max_overflow more under load; 'static' shares one connection and 'null' opens a new
+    # connection for every checkout. A read_only engine opens the file with SQLite's mode=ro, so none of
+    # its connections can write.
+    if pool not in DATABASE_POOLS:
+        raise ValueError('Unknown database pool: {}'.format(pool))
+    if profile not in SQLITE_PROFILES:
+        raise ValueError('Unknown SQLite profile: {}'.format(profile))
+    if is_in_memory_database(database_uri):
+        if read_only:
+            raise ValueError('An in-memory database cannot be opened read-only by a separate engine')
+        # Every connection to an in-memory database is a separate, empty database.
+        pool = 'static'
+    if read_only:
+        database_uri = read_only_database_uri(database_uri)
+
+    options = {}
+    if pool == 'queue':
+        options['pool_size'] = pool_size
+        options['max_overflow'] = max_overflow
+    engine = create_engine(database_uri, connect_args={"check_same_thread": False},
+                           poolclass=DATABASE_POOLS[pool], echo=echo, **options)
+
+    pragmas = SQLITE_PROFILES[profile]
+    if len(pragmas) > 0:
+        @event.listens_for(engine, 'connect')
+        def apply_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas.items():
+                cursor.execute('PRAGMA {} = {}'.format(name, value))
+            cursor.close()
+
+    return engine
+
+
+def is_in_memory_database(database_uri: str) -> bool:
+    return make_url(database_uri).database in (None, '', ':memory:')
+
+
+def read_only_database_uri(database_uri: str) -> str:
+    # sqlite:///movies.db -> sqlite:///file:/absolute/path/movies.db?mode=ro&uri=true
+    path = os.path.abspath(make_url(database_uri).database)
+    return 'sqlite:///file:{}?mode=ro&uri=true'.format(pathname2url(path))
+
+
+def optimize_database(engine: Engine):
+    # Lets SQLite refresh the planner statistics of tables that changed a lot since the last ANALYZE.
+    with engine.connect() as connection:
+        connection.execute('PRAGMA optimize')
 
 
 class SqlAlchemyRepository(AbstractRepository):
-    def __init__(self, session_factory):
+    def __init__(self, session_factory, read_session_factory=None, review_writer=None):
+        # add_* calls write through session_factory. get_* calls read through read_session_factory when
+        # one is given, normally bound to a read-only engine, so readers never queue behind the writer.
+        # With a review_writer (a ReviewWriteBehind), add_review queues the review for a batched write.
         self._session_cm = SessionContextManager(session_factory)
+        self._review_writer = review_writer
+        self.review_listeners = []
+        if review_writer is not None:
+            review_writer.listeners.append(self._notify_review_listeners)
+        if read_session_factory is None:
+            self._read_cm = self._session_cm
+        else:
+            self._read_cm = SessionContextManager(read_session_factory)
         self.dataset_of_movies = []
 
     def close_session(self):
         self._session_cm.close_current_session()
+        if self._read_cm is not self._session_cm:
+            self._read_cm.close_current_session()
 
     def reset_session(self):
         self._session_cm.reset_session()
+        if self._read_cm is not self._session_cm:
+            self._read_cm.reset_session()
 
-    def add_actor(self, actor: Actor):
+    def _add(self, entity):
         with self._session_cm as scm:
-            scm.session.add(actor)
+            scm.session.add(entity)
             scm.commit()
+        if self._read_cm is not self._session_cm:
+            # Later reads in the same request must see the write, not what the read session cached.
+            self._read_cm.session.expire_all()
+
+    def add_actor(self, actor: Actor):
+        if self.get_actor(actor.actor_full_name) is not None:
+            return
+        self._add(actor)
 
     def add_director(self, director: Director):
-        with self._session_cm as scm:
-            scm.session.add(director)
-            scm.commit()
+        if self.get_director(director.director_full_name) is not None:
+            return
+        self._add(director)
 
     def add_genre(self, genre: Genre):
-        with self._session_cm as scm:
-            scm.session.add(genre)
-            scm.commit()
+        if self.get_genre(genre.genre_name) is not None:
+            return
+        self._add(genre)
 
     def add_movie(self, id,title,year,description,director,actor,genre,runtime,rating,revenue,meta, vote):
+        # People and genres have one row each, so the movie is linked to existing ones where possible.
+        # They are all looked up before the movie is linked to any of them: linking puts the movie in the
+        # session, and a lookup after that would autoflush it before its id is set.
+        # The lookups go through the writing session, as the movie can only be linked to objects in it.
+        session = self._session_cm.session
+        directors = [session.query(Director).filter_by(director_full_name=director).first() or Director(director)]
+        actors = [session.query(Actor).filter_by(actor_full_name=a.strip()).first() or Actor(a.strip())
+                  for a in actor.split(",")]
+        genres = [session.query(Genre).filter_by(genre_name=g.strip()).first() or Genre(g.strip())
+                  for g in genre.split(",")]
+
         movie = Movie(title,year)
+        movie.id = id
         movie.description = description
-        movie.director = [Director(director)]
-        actors = actor.split(",")
-        for a in actors:
-            movie.add_actor(Actor(a.strip()))
-        genres = genre.split(",")
-        for g in genres:
-            movie.add_genre(Genre(g))
         movie.runtime = runtime
         movie.rating = rating
         if revenue != "N/A":
@@ -91,26 +202,50 @@ class SqlAlchemyRepository(AbstractRepository):
         if meta != "N/A":
             movie.meta = int(meta)
         movie.vote = vote
-        movie.id = id
+        movie.director = directors
+        for a in actors:
+            movie.add_actor(a)
+        for g in genres:
+            movie.add_genre(g)
 
         with self._session_cm as scm:
             scm.session.add(movie)
+            scm.session.execute(SEARCH_INDEX_ADD_MOVIE, dict(id=movie.id, title=title, description=description))
             scm.commit()
+        if self._read_cm is not self._session_cm:
+            self._read_cm.session.expire_all()
 
     def add_user(self, user: User):
-        with self._session_cm as scm:
-            scm.session.add(user)
-            scm.commit()
+        self._add(user)
 
     def add_review(self, review: Review):
+        if self._review_writer is not None:
+            self._review_writer.add(review)
+            return
+        # Read before the commit expires the review.
+        subjects = review.subjects()
         with self._session_cm as scm:
-            scm.session.add(review)
+            add_reviews(scm.session, [review])
             scm.commit()
+        if self._read_cm is not self._session_cm:
+            self._read_cm.session.expire_all()
+        self._notify_review_listeners(subjects)
+
+    def _notify_review_listeners(self, subjects):
+        for listener in self.review_listeners:
+            listener(subjects)
+
+    def flush_reviews(self, user_name=None):
+        # Writes queued reviews now: all of them, or only if user_name has one waiting.
+        if self._review_writer is None or self._review_writer.flush(user_name) == 0:
+            return
+        if self._read_cm is not self._session_cm:
+            self._read_cm.session.expire_all()
 
     def get_actor(self, actor_name) -> Actor:
         actor = None
         try:
-            actor = self._session_cm.session.query(Actor).filter_by(actor_full_name=actor_name).all()
+            actor = self._read_cm.session.query(Actor).filter_by(actor_full_name=actor_name).one()
         except NoResultFound:
             pass
         return actor
@@ -118,7 +253,7 @@ class SqlAlchemyRepository(AbstractRepository):
     def get_director(self, director_name) -> Director:
         director = None
         try:
-            director = self._session_cm.session.query(Director).filter_by(director_full_name=director_name).all()
+            director = self._read_cm.session.query(Director).filter_by(director_full_name=director_name).one()
         except NoResultFound:
             pass
         return director
@@ -126,103 +261,614 @@ class SqlAlchemyRepository(AbstractRepository):
     def get_genre(self, genre_name) -> Genre:
         genre = None
         try:
-            genre = self._session_cm.session.query(Genre).filter_by(genre_name=genre_name).all()
+            genre = self._read_cm.session.query(Genre).filter_by(genre_name=genre_name).one()
         except NoResultFound:
             pass
         return genre
 
-    def get_movie(self, title) -> Movie:
-        movie = None
-        try:
-            movie = self._session_cm.session.query(Movie).filter_by(title=title).one()
-        except NoResultFound:
-            pass
-        return movie
+    def get_review_aggregate(self, kind, key) -> ReviewAggregate:
+        return self._read_cm.session.query(ReviewAggregate).get((kind, key))
+
+    def get_review_aggregates(self, kind, keys):
+        keys = set(keys)
+        if not keys:
+            return {}
+        query = self._read_cm.session.query(ReviewAggregate).filter(
+            ReviewAggregate.kind == kind, ReviewAggregate.key.in_(keys))
+        return {aggregate.key: aggregate for aggregate in query}
+
+    def get_top_rated(self, kind, limit=10) -> List[ReviewAggregate]:
+        query = self._read_cm.session.query(ReviewAggregate).filter(
+            ReviewAggregate.kind == kind, ReviewAggregate.rating_mean.isnot(None))
+        return query.order_by(desc(ReviewAggregate.rating_mean), ReviewAggregate.key).limit(limit).all()
+
+    def get_names_starting_with(self, kind, prefix, limit=10) -> List[str]:
+        if kind not in NAME_KINDS:
+            raise ValueError('Unknown kind of name: {}'.format(kind))
+        pattern = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        rows = self._read_cm.session.execute(NAMES_STARTING_WITH[kind], dict(pattern=pattern, limit=limit))
+        return [name for (name,) in rows]
+
+    def get_movie(self, title, load=()) -> Movie:
+        # Titles are not unique; like the memory repository, the first movie with the title is returned.
+        query = self._read_cm.session.query(Movie).options(*loading_options(load))
+        return query.filter_by(title=title).order_by(Movie.id).first()
 
     def get_user(self, user_name) -> User:
         user = None
         try:
-            user = self._session_cm.session.query(User).filter_by(user_name=user_name.lower()).one()
+            user = self._read_cm.session.query(User).filter_by(user_name=user_name.lower()).one()
         except NoResultFound:
             pass
         return user
 
     def get_review(self):
-        reviews = self._session_cm.session.query(Review).all()
+        reviews = self._read_cm.session.query(Review).all()
         return reviews
 
-    def get_dataset_of_movies(self):
-        dataset_of_movies = self._session_cm.session.query(Movie).all()
+    def find_reviews(self, user=None, movie=None, offset=0, limit=None):
+        # Each row carries the total number of matches, as in find_movies.
+        query = self._read_cm.session.query(Review, func.count().over().label('review_count'))
+        if user is not None:
+            query = query.filter(orm.reviews.c.user == user)
+        if movie is not None:
+            query = query.filter(orm.reviews.c.movie == movie)
+        page = query.order_by(orm.reviews.c.id).offset(offset)
+        if limit is not None:
+            page = page.limit(limit)
+        rows = page.all()
+        if len(rows) > 0:
+            return [review for review, review_count in rows], rows[0].review_count
+        if offset == 0:
+            return [], 0
+        return [], query.with_entities(func.count(orm.reviews.c.id)).scalar()
+
+    def get_dataset_of_movies(self, load=()):
+        dataset_of_movies = self._read_cm.session.query(Movie).options(*loading_options(load)).all()
         return dataset_of_movies
 
+    def get_movies_by_ids(self, ids, load=()):
+        ids = list(ids)
+        if not ids:
+            return []
+        query = self._read_cm.session.query(Movie).options(*loading_options(load))
+        movies = query.filter(Movie.id.in_(ids)).all()
+        movies_by_id = {movie.id: movie for movie in movies}
+        return [movies_by_id[movie_id] for movie_id in ids if movie_id in movies_by_id]
+
+    def find_movie_ids(self, genres=(), actors=(), director=None, offset=0, limit=None):
+        directors = () if director is None else (director,)
+        if len(genres) == 0 and len(actors) == 0 and len(directors) == 0:
+            session = self._read_cm.session
+            query = session.query(orm.movies.c.id).order_by(orm.movies.c.id).offset(offset)
+            if limit is not None:
+                query = query.limit(limit)
+            return [movie_id for (movie_id,) in query], session.query(func.count(orm.movies.c.id)).scalar()
+        return self._find_matching_movie_ids(genres, actors, directors, offset, limit)
+
+    def iter_movie_ids(self, genres=(), actors=(), director=None, offset=0):
+        # One query, whose rows SQLite steps through as they are read.
+        matches = movie_ids_with_names(genres, actors, () if director is None else (director,))
+        if matches is None:
+            matches = select([orm.movies.c.id.label('movie_id')])
+        for (movie_id,) in self._read_cm.session.execute(matches.order_by('movie_id').offset(offset)):
+            yield movie_id
+
+    def find_movies(self, genres=(), actors=(), director=None, offset=0, limit=None, load=()):
+        directors = () if director is None else (director,)
+        if len(genres) == 0 and len(actors) == 0 and len(directors) == 0:
+            query = self._read_cm.session.query(Movie)
+            movie_count = query.count()
+            query = query.options(*loading_options(load)).order_by(orm.movies.c.id).offset(offset)
+            if limit is not None:
+                query = query.limit(limit)
+            return query.all(), movie_count
+        movie_ids, movie_count = self._find_matching_movie_ids(genres, actors, directors, offset, limit)
+        return self.get_movies_by_ids(movie_ids, load), movie_count
+
+    def _find_matching_movie_ids(self, genres, actors, directors, offset, limit):
+        # One query finds every match and returns the ids on the page, each carrying the total number of
+        # matches; the grouping has to see every match anyway, so counting them on the side is free.
+        matches = movie_ids_with_names(genres, actors, directors).alias('matches')
+        page = select([matches.c.movie_id, func.count().over().label('movie_count')]) \
+            .order_by(matches.c.movie_id).offset(offset)
+        if limit is not None:
+            page = page.limit(limit)
+        rows = self._read_cm.session.execute(page).fetchall()
+        if len(rows) > 0:
+            return [row.movie_id for row in rows], rows[0].movie_count
+        if offset == 0:
+            return [], 0
+        # Paged past the last match, so there is no row to read the total from.
+        return [], self._read_cm.session.execute(select([func.count()]).select_from(matches)).scalar()
+
+    def search_movies(self, query, offset=0, limit=None, load=()):
+        phrases = parse_query(query)
+        if len(phrases) == 0:
+            return [], 0
+        # Every phrase is quoted, and holds only word characters, so nothing in the query is FTS5 syntax.
+        match = ' '.join('"{}"'.format(' '.join(phrase)) for phrase in phrases)
+        rows = self._read_cm.session.execute(SEARCH_MOVIES, dict(
+            match=match, offset=offset, limit=-1 if limit is None else limit)).fetchall()
+        if len(rows) > 0:
+            return self.get_movies_by_ids([row.movie_id for row in rows], load), rows[0].movie_count
+        if offset == 0:
+            return [], 0
+        return [], self._read_cm.session.execute(COUNT_SEARCH_MATCHES, dict(match=match)).scalar()
+
+    def get_movie_ids_by_values(self, ranges=None, order_by=None, descending=False, limit=None):
+        query = self._read_cm.session.query(orm.movies.c.id)
+        for name, (low, high) in (ranges or {}).items():
+            column = orm.movies.c[MOVIE_VALUE_COLUMNS[name]]
+            value = cast(column, Float)
+            query = query.filter(column != 'N/A')
+            if low is not None:
+                query = query.filter(value >= low)
+            if high is not None:
+                query = query.filter(value <= high)
+        if order_by is not None:
+            column = orm.movies.c[MOVIE_VALUE_COLUMNS[order_by]]
+            value = cast(column, Float)
+            query = query.order_by(column == 'N/A', desc(value) if descending else asc(value))
+        query = query.order_by(orm.movies.c.id)
+        if limit is not None:
+            query = query.limit(limit)
+        return [row[0] for row in query]
+
+
+def loading_options(load):
+    # Each relationship in the loading plan is fetched for every Movie in the result with one extra
+    # SELECT ... WHERE movie_id IN (...), instead of one lazy load per Movie when it is first touched.
+    options = []
+    for name in load:
+        if name not in MOVIE_RELATIONSHIPS:
+            raise ValueError('Unknown Movie relationship in loading plan: {}'.format(name))
+        options.append(selectinload(getattr(Movie, name)))
+    return options
+
+
+# Movie attribute -> movies table column, for the numeric attributes stored as text in the database.
+MOVIE_VALUE_COLUMNS = {
+    'time': 'time',
+    'rating': 'rating',
+    'runtime_minutes': 'runtime',
+    'revenue': 'revenue',
+    'meta': 'metascore',
+    'vote': 'votes',
+}
+
+
+def movie_ids_with_names(genres=(), actors=(), directors=()):
+    # Returns a SELECT of the ids of the movies linked to every one of the given names, or None if no names
+    # are given. The links to any of the names are gathered with UNION ALL and grouped by movie; a movie
+    # has all of the names when its group has one link per name.
+    links = []
+    name_count = 0
+    for junction, entity_id, table, column, names in (
+            (orm.movie_genres, orm.movie_genres.c.genre_id, orm.genres, orm.genres.c.genre_name, genres),
+            (orm.movie_actors, orm.movie_actors.c.actor_id, orm.actors, orm.actors.c.actor_full_name, actors),
+            (orm.movie_directors, orm.movie_directors.c.director_id, orm.directors, orm.directors.c.director_full_name, directors)):
+        names = set(names)
+        if len(names) == 0:
+            continue
+        links.append(select([junction.c.movie_id.label('movie_id')])
+                     .select_from(junction.join(table, table.c.id == entity_id))
+                     .where(column.in_(names)))
+        name_count += len(names)
+    if len(links) == 0:
+        return None
+
+    links = union_all(*links).alias('links')
+    return select([links.c.movie_id]).group_by(links.c.movie_id).having(func.count() == name_count)
+
+
+# Rows sent to the database per executemany call while populating.
+POPULATE_BATCH_SIZE = 10000
+
+# Durability settings used only while populating; a failed load is simply rerun from the CSV.
+BULK_LOAD_PRAGMAS = {
+    'journal_mode': 'MEMORY',
+    'synchronous': 'OFF',
+}
+
+INSERT_MOVIES = """
+    INSERT INTO movies (
+    id,title,description,time,runtime,rating,votes,revenue,metascore)
+    VALUES (?,?,?,?,?,?,?,?,?)"""
+
+INSERT_DIRECTORS = """
+    INSERT INTO directors (
+    id,director_full_name,rating,rating_num)
+    VALUES (?,?,0,0)"""
+
+INSERT_ACTORS = """
+    INSERT INTO actors (
+    id,actor_full_name,rating,rating_num)
+    VALUES (?,?,0,0)"""
+
+INSERT_GENRES = """
+    INSERT INTO genres (
+    id,genre_name,rating,rating_num)
+    VALUES (?,?,0,0)"""
+
+INSERT_MOVIE_DIRECTORS = """
+    INSERT OR IGNORE INTO movie_directors (
+    movie_id,director_id)
+    VALUES (?,?)"""
+
+INSERT_MOVIE_ACTORS = """
+    INSERT OR IGNORE INTO movie_actors (
+    movie_id,actor_id)
+    VALUES (?,?)"""
+
+INSERT_MOVIE_GENRES = """
+    INSERT OR IGNORE INTO movie_genres (
+    movie_id,genre_id)
+    VALUES (?,?)"""
+
+
+class BatchInserter:
+    # Buffers rows for one INSERT statement and sends them with executemany once batch_size rows are waiting.
+    def __init__(self, cursor, statement, batch_size):
+        self.cursor = cursor
+        self.statement = statement
+        self.batch_size = batch_size
+        self.rows = []
+        self.row_count = 0
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.cursor.executemany(self.statement, self.rows)
+            self.row_count += len(self.rows)
+            self.rows = []
+
+
+class NameIds:
+    # Hands out the row id of each director/actor/genre name, queueing an insert the first time a name is seen.
+    def __init__(self, cursor, table, name_column, inserter):
+        self.ids = dict(cursor.execute('SELECT {}, id FROM {}'.format(name_column, table)))
+        self.next_id = max(self.ids.values(), default=0) + 1
+        self.inserter = inserter
+
+    def id_for(self, name):
+        entity_id = self.ids.get(name)
+        if entity_id is None:
+            entity_id = self.ids[name] = self.next_id
+            self.next_id += 1
+            self.inserter.add((entity_id, name))
+        return entity_id
+
+
+class PopulateReport:
+    def __init__(self, row_counts, seconds):
+        self.row_counts = row_counts
+        self.seconds = seconds
 
-def movie_record_generator(filename: str):
-    with open(filename, mode='r', encoding='utf-8-sig') as infile:
-        reader = csv.reader(infile)
-        next(reader)
-        for row in reader:
-            row = [item.strip() for item in row]
-            yield row[0:2] + [row[3]] + row[6:]
-
-def director_record_generator(filename:str):
-    with open(filename, mode='r', encoding='utf-8-sig') as infile:
-        reader = csv.reader(infile)
-        next(reader)
-        for row in reader:
-            yield [row[1],row[4]]
-
-
-def actor_record_generator(filename:str,cursor):
-    with open(filename, mode='r', encoding='utf-8-sig') as infile:
-        reader = csv.reader(infile)
-        next(reader)
-        for row in reader:
-            row1 = row[5].split(',')
-            insert_actors = """
-                   INSERT INTO actors (
-                   movie,actor_full_name,rating,rating_num)
-                   VALUES (?,?,0,0)"""
-            for i in row1:
-                cursor.executemany(insert_actors, [[row[1],i.strip()]])
-
-
-def genre_record_generator(filename:str,cursor):
-    with open(filename, mode='r', encoding='utf-8-sig') as infile:
-        reader = csv.reader(infile)
-        next(reader)
-        for row in reader:
-            row1 = row[2].split(',')
-            insert_genres = """
-                    INSERT INTO genres (
-                    movie,genre_name,rating,rating_num)
-                    VALUES (?,?,0,0)"""
-            for i in row1:
-                cursor.executemany(insert_genres,[[row[1],i.strip()]])
-
-
-def populate(engine: Engine, data_path: str):
-    connect = engine.raw_connection()
-    cursor = connect.cursor()
-
-    insert_movies = """
-               INSERT INTO movies (
-               id,title,description,time,runtime,rating,votes,revenue,metascore)
-               VALUES ( ?,?,?,?,?,?,?,?,?)"""
-    cursor.executemany(insert_movies, movie_record_generator(data_path))
+    @property
+    def rows(self):
+        return sum(self.row_counts.values())
 
+    @property
+    def rows_per_second(self):
+        if self.seconds <= 0:
+            return float(self.rows)
+        return self.rows / self.seconds
 
-    insert_directors = """
-               INSERT INTO directors (
-               movie,director_full_name,rating,rating_num)
-               VALUES (?,?,0,0)"""
-    cursor.executemany(insert_directors,director_record_generator(data_path))
+    def __repr__(self):
+        return "<Populated {} rows in {:.2f}s, {:.0f} rows/s>".format(self.rows, self.seconds, self.rows_per_second)
 
-    genre_record_generator(data_path, cursor)
 
-    actor_record_generator(data_path,cursor)
+# The tables populate() loads from the CSV. Everything else is written by the app.
+CATALOG_TABLES = (orm.movies, orm.directors, orm.actors, orm.genres,
+                  orm.movie_directors, orm.movie_actors, orm.movie_genres)
 
 
-    connect.commit()
-    connect.close()
+def populate(engine: Engine, data_path: str, batch_size: int = POPULATE_BATCH_SIZE):
+    # Loads the CSV in one pass and one transaction. Indexes on the loaded tables are dropped first
+    # and rebuilt once the data is in. Returns the number of rows inserted per table and the load rate.
+    started = time.perf_counter()
+    loaded_tables = list(CATALOG_TABLES)
+    indexes = [index for table in loaded_tables for index in table.indexes]
 
+    connect = engine.raw_connection()
+    cursor = connect.cursor()
+    previous_pragmas = {}
+    try:
+        for name, value in BULK_LOAD_PRAGMAS.items():
+            previous = cursor.execute('PRAGMA {}'.format(name)).fetchone()[0]
+            if name == 'journal_mode' and previous == 'wal':
+                # Leaving WAL needs the only connection to the file, which other pooled connections
+                # prevent, and appending to the WAL is already cheap.
+                continue
+            previous_pragmas[name] = previous
+            cursor.execute('PRAGMA {} = {}'.format(name, value))
+
+        for index in indexes:
+            cursor.execute('DROP INDEX IF EXISTS {}'.format(index.name))
+        # The CSV replaces the catalog already loaded, if any.
+        for table in reversed(loaded_tables):
+            cursor.execute('DELETE FROM {}'.format(table.name))
+
+        movies = BatchInserter(cursor, INSERT_MOVIES, batch_size)
+        directors = BatchInserter(cursor, INSERT_DIRECTORS, batch_size)
+        actors = BatchInserter(cursor, INSERT_ACTORS, batch_size)
+        genres = BatchInserter(cursor, INSERT_GENRES, batch_size)
+        movie_directors = BatchInserter(cursor, INSERT_MOVIE_DIRECTORS, batch_size)
+        movie_actors = BatchInserter(cursor, INSERT_MOVIE_ACTORS, batch_size)
+        movie_genres = BatchInserter(cursor, INSERT_MOVIE_GENRES, batch_size)
+        director_ids = NameIds(cursor, 'directors', 'director_full_name', directors)
+        actor_ids = NameIds(cursor, 'actors', 'actor_full_name', actors)
+        genre_ids = NameIds(cursor, 'genres', 'genre_name', genres)
+
+        # Junction rows are queued in CSV order, so their ids keep each movie's credits in order.
+        for (rank, title, year, description, director, actor_names, genre_names,
+             runtime, rating, revenue, meta, votes) in movie_records(data_path):
+            movie_id = int(rank)
+            movies.add((movie_id, title, description, year, runtime, rating, votes, revenue, meta))
+            movie_directors.add((movie_id, director_ids.id_for(director)))
+            for actor_name in actor_names:
+                movie_actors.add((movie_id, actor_ids.id_for(actor_name)))
+            for genre_name in genre_names:
+                movie_genres.add((movie_id, genre_ids.id_for(genre_name)))
+        inserters = (movies, directors, actors, genres, movie_directors, movie_actors, movie_genres)
+        for inserter in inserters:
+            inserter.flush()
+
+        for index in indexes:
+            cursor.execute(str(CreateIndex(index).compile(dialect=engine.dialect)))
+        build_search_index(cursor)
+        # Give the planner statistics for the freshly loaded tables and indexes.
+        cursor.execute('ANALYZE')
+        connect.commit()
+    finally:
+        # The connection goes back to the pool, so it leaves with its settings restored even if the load
+        # failed. Some pragmas cannot change inside a transaction, so a failed one is rolled back first.
+        connect.rollback()
+        for name, value in previous_pragmas.items():
+            cursor.execute('PRAGMA {} = {}'.format(name, value))
+        connect.close()
+
+    row_counts = {table.name: inserter.row_count for table, inserter in zip(loaded_tables, inserters)}
+    seconds = time.perf_counter() - started
+    return PopulateReport(row_counts, seconds)
+
+
+# The original layout had one directors/actors/genres row per (movie title, name) pair.
+LEGACY_ENTITY_TABLES = (
+    (orm.directors, 'director_full_name', orm.movie_directors, 'director_id'),
+    (orm.actors, 'actor_full_name', orm.movie_actors, 'actor_id'),
+    (orm.genres, 'genre_name', orm.movie_genres, 'genre_id'),
+)
+
+
+def has_legacy_schema(engine: Engine) -> bool:
+    inspector = inspect(engine)
+    if 'actors' not in inspector.get_table_names():
+        return False
+    return 'movie' in [column['name'] for column in inspector.get_columns('actors')]
+
+
+def migrate_legacy_schema(engine: Engine) -> bool:
+    # Moves a database in the original layout to one row per director/actor/genre plus junction tables,
+    # in a single transaction. Ratings of a name's duplicate rows are summed. Returns False if the
+    # database was not in the original layout.
+    if not has_legacy_schema(engine):
+        return False
 
+    connect = engine.raw_connection()
+    try:
+        cursor = connect.cursor()
+        # Without this, renaming a table would also repoint the reviews foreign keys at the renamed table.
+        cursor.execute('PRAGMA legacy_alter_table = ON')
+        cursor.execute('BEGIN')
+        for table, name_column, junction, entity_id in LEGACY_ENTITY_TABLES:
+            legacy_indexes = cursor.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+                (table.name,)).fetchall()
+            for (index_name,) in legacy_indexes:
+                cursor.execute('DROP INDEX {}'.format(index_name))
+            cursor.execute('ALTER TABLE {0} RENAME TO legacy_{0}'.format(table.name))
+
+        for table, name_column, junction, entity_id in LEGACY_ENTITY_TABLES:
+            for new_table in (table, junction):
+                cursor.execute(str(CreateTable(new_table).compile(dialect=engine.dialect)))
+                for index in new_table.indexes:
+                    cursor.execute(str(CreateIndex(index).compile(dialect=engine.dialect)))
+            cursor.execute("""
+                INSERT INTO {table} ({name}, rating, rating_num, add_url)
+                SELECT {name}, SUM(rating), SUM(rating_num), MAX(add_url)
+                FROM legacy_{table} GROUP BY {name} ORDER BY MIN(id)""".format(table=table.name, name=name_column))
+            cursor.execute("""
+                INSERT OR IGNORE INTO {junction} (movie_id, {entity_id})
+                SELECT movies.id, {table}.id
+                FROM legacy_{table}
+                JOIN movies ON movies.title = legacy_{table}.movie
+                JOIN {table} ON {table}.{name} = legacy_{table}.{name}
+                ORDER BY legacy_{table}.id, movies.id""".format(
+                table=table.name, name=name_column, junction=junction.name, entity_id=entity_id))
+            cursor.execute('DROP TABLE legacy_{}'.format(table.name))
+
+        existing_indexes = {name for (name,) in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        for table in (orm.movies, orm.reviews):
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    cursor.execute(str(CreateIndex(index).compile(dialect=engine.dialect)))
+        connect.commit()
+    except Exception:
+        connect.rollback()
+        raise
+    finally:
+        connect.close()
+    return True
+
+
+# LIKE ignores case, as does the NOCASE index on each name column, so SQLite reads a prefix's names as one
+# range of the index, already in order. A text statement skips compiling a query on every keystroke.
+NAMES_STARTING_WITH = {
+    kind: text("SELECT {column} FROM {table} WHERE {column} LIKE :pattern ESCAPE '\\' "
+               "ORDER BY {column} COLLATE NOCASE LIMIT :limit".format(table=table.name, column=column))
+    for kind, table, column in (('actor', orm.actors, 'actor_full_name'),
+                                ('director', orm.directors, 'director_full_name'),
+                                ('genre', orm.genres, 'genre_name'))
+}
+
+
+# Full-text index over the title, description and movie reviews of every movie; the rowid is the movie id.
+# A review is shown with every movie of the title it names, so it is indexed with all of them too.
+SEARCH_TABLE = 'movie_search'
+CREATE_SEARCH_TABLE = "CREATE VIRTUAL TABLE {} USING fts5({}, tokenize = 'unicode61 remove_diacritics 2')".format(
+    SEARCH_TABLE, ', '.join(SEARCH_FIELDS))
+SEARCH_INDEX_ADD_MOVIE = text(
+    "INSERT INTO movie_search (rowid, title, description, reviews) VALUES (:id, :title, :description, '')")
+SEARCH_INDEX_ADD_REVIEW = text("""
+    UPDATE movie_search SET reviews = reviews || ' ' || :review
+    WHERE rowid IN (SELECT id FROM movies WHERE title = :title)""")
+# bm25() cannot be used in the same query as a window function, hence the subquery.
+SEARCH_MOVIES = text("""
+    SELECT movie_id, count(*) OVER () AS movie_count FROM (
+        SELECT rowid AS movie_id, bm25(movie_search, {}) AS score FROM movie_search
+        WHERE movie_search MATCH :match)
+    ORDER BY score, movie_id
+    LIMIT :limit OFFSET :offset""".format(', '.join(str(weight) for weight in SEARCH_WEIGHTS)))
+COUNT_SEARCH_MATCHES = text("SELECT count(*) FROM movie_search WHERE movie_search MATCH :match")
+
+
+def build_search_index(connection):
+    # (Re)creates movie_search from the movies and reviews tables. Takes a DB-API cursor or an SQLAlchemy
+    # connection, and runs in the caller's transaction.
+    connection.execute('DROP TABLE IF EXISTS {}'.format(SEARCH_TABLE))
+    connection.execute(CREATE_SEARCH_TABLE)
+    connection.execute("""
+        INSERT INTO movie_search (rowid, title, description, reviews)
+        SELECT movies.id, movies.title, movies.description,
+               coalesce((SELECT group_concat(review, ' ') FROM reviews WHERE reviews.movie = movies.title), '')
+        FROM movies""")
+
+
+# Folds the totals of a batch of reviews into review_aggregates, creating the rows that do not exist yet.
+REVIEW_AGGREGATE_UPSERT = text("""
+    INSERT INTO review_aggregates (kind, key, rating_sum, rating_count, rating_mean, review_count, last_reviewed)
+    VALUES (:kind, :key, :rating_sum, :rating_count, :rating_mean, :review_count, :last_reviewed)
+    ON CONFLICT (kind, key) DO UPDATE SET
+        rating_sum = rating_sum + excluded.rating_sum,
+        rating_count = rating_count + excluded.rating_count,
+        rating_mean = CAST(rating_sum + excluded.rating_sum AS REAL) / NULLIF(rating_count + excluded.rating_count, 0),
+        review_count = review_count + excluded.review_count,
+        last_reviewed = max(coalesce(last_reviewed, excluded.last_reviewed), excluded.last_reviewed)
+    """).bindparams(bindparam('last_reviewed', type_=DateTime))
+
+
+def add_reviews(session, reviews):
+    # Adds the reviews to the session and updates the aggregates of everything they are about, and the
+    # search index of the movies they review, in the same transaction, so both are committed with the
+    # reviews or not at all. A batch needs one upsert per movie, director, genre or actor it reviews,
+    # however many reviews it has.
+    session.add_all(reviews)
+    movie_reviews = [dict(title=review.movie, review=review.review_text) for review in reviews
+                     if review.movie is not None]
+    if movie_reviews:
+        session.execute(SEARCH_INDEX_ADD_REVIEW, movie_reviews)
+    aggregates = dict()
+    for review in reviews:
+        for kind, key in review.subjects():
+            if (kind, key) not in aggregates:
+                aggregates[(kind, key)] = ReviewAggregate(kind, key)
+            aggregates[(kind, key)].add(review)
+    if aggregates:
+        session.execute(REVIEW_AGGREGATE_UPSERT, [
+            dict(kind=a.kind, key=a.key, rating_sum=a.rating_sum, rating_count=a.rating_count,
+                 rating_mean=a.rating_mean, review_count=a.review_count, last_reviewed=a.last_reviewed) for a in aggregates.values()])
+
+
+def rebuild_review_aggregates(engine: Engine):
+    # Recomputes review_aggregates from the reviews table, e.g. for reviews migrated from an older schema.
+    with engine.begin() as connection:
+        connection.execute(orm.review_aggregates.delete())
+        for kind, column in (('movie', 'movie'), ('director', 'directors'), ('genre', 'genres'), ('actor', 'actors')):
+            connection.execute("""
+                INSERT INTO review_aggregates (kind, key, rating_sum, rating_count, rating_mean, review_count,
+                                               last_reviewed)
+                SELECT '{kind}', {column}, coalesce(sum(rating), 0), count(rating), avg(rating), count(*),
+                       max(timestamp)
+                FROM reviews WHERE {column} IS NOT NULL GROUP BY {column}""".format(kind=kind, column=column))
+
+
+def rebuild_catalog(engine: Engine, data_path: str):
+    # Reloads the movies, directors, actors and genres from data_path, keeping the users and their reviews.
+    # Reviews name the movie, director, genre or actor they are about, so they link to the reloaded catalog
+    # by name, and the search index and review aggregates are rebuilt from them.
+    report = populate(engine, data_path)
+    rebuild_review_aggregates(engine)
+    record_database_build(engine, data_path)
+    return report
+
+
+def migrate_schema(engine: Engine) -> set:
+    # Adds the tables, columns and indexes of orm.metadata that the database lacks, and builds movie_search
+    # and review_aggregates if they are new or changed, since both are derived from the other tables. Nothing
+    # is dropped, so users and reviews survive any version of the app. Returns the names of the tables created
+    # or given new columns, whose rows may need filling.
+    changed = set()
+    with engine.begin() as connection:
+        inspector = inspect(connection)
+        existing_tables = set(inspector.get_table_names())
+        existing_indexes = {name for (name,) in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        for table in orm.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                table.create(connection)
+                changed.add(table.name)
+                continue
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing_columns:
+                    connection.execute('ALTER TABLE {} ADD COLUMN {}'.format(
+                        table.name, CreateColumn(column).compile(dialect=engine.dialect)))
+                    changed.add(table.name)
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(connection)
+        if SEARCH_TABLE not in existing_tables:
+            build_search_index(connection)
+            changed.add(SEARCH_TABLE)
+    if orm.review_aggregates.name in changed:
+        rebuild_review_aggregates(engine)
+    return changed
+
+
+def read_schema_info(engine: Engine) -> dict:
+    if orm.schema_info.name not in inspect(engine).get_table_names():
+        return {}
+    return dict(engine.execute(select([orm.schema_info.c.key, orm.schema_info.c.value])).fetchall())
+
+
+def database_is_current(engine: Engine, data_path: str) -> bool:
+    # True if the database was completely built from the current contents of data_path. Only the file size
+    # and modification time are checked unless they disagree with the recorded ones, in which case the file
+    # is hashed.
+    info = read_schema_info(engine)
+    if 'source' not in info:
+        return False
+    try:
+        return matches_source(json.loads(info['source']), data_path)
+    except OSError:
+        # No CSV to rebuild from (e.g. a deployment that only ships the database): keep what was built.
+        return True
+    except (ValueError, KeyError):
+        return False
+
+
+def record_database_build(engine: Engine, data_path: str):
+    # Written after populate() has committed, so an interrupted build is never mistaken for a complete one.
+    # build names this build, whose pages may differ from the last one's even when the CSV is the same.
+    rows = [
+        {'key': 'source', 'value': json.dumps(file_fingerprint(data_path))},
+        {'key': 'build', 'value': uuid.uuid4().hex},
+    ]
+    with engine.begin() as connection:
+        connection.execute(orm.schema_info.delete())
+        connection.execute(orm.schema_info.insert(), rows)
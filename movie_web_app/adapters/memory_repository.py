@@ -1,9 +1,17 @@
 # memory_repository.py
 import csv
+import gc
+import threading
 from abc import ABC
+from bisect import bisect_left, bisect_right
+from heapq import nsmallest
+from itertools import islice
 
-from movie_web_app.domain.model import Movie, Actor, Director, Genre, Review, User
-from movie_web_app.adapters.repository import AbstractRepository
+from movie_web_app.domain.model import Movie, Actor, Director, Genre, Review, ReviewAggregate, User
+from movie_web_app.adapters.repository import AbstractRepository, NAME_KINDS
+from movie_web_app.adapters.column_store import MovieColumnStore
+from movie_web_app.adapters.text_index import MovieTextIndex, parse_query
+from movie_web_app.adapters import snapshot
 
 
 
@@ -17,30 +25,101 @@ class MemoryRepository(AbstractRepository):
         self.users = []
         self.reviews = []
         self.tags = []
+        self.review_listeners = []
+
+        # Primary indexes, kept in sync by the add_* methods so lookups are O(1).
+        self._actors_by_name = dict()
+        self._directors_by_name = dict()
+        self._genres_by_name = dict()
+        self._movies_by_title = dict()
+        self._users_by_name = dict()
+        self._movies_by_id = dict()
+        self._movie_ids = []
+
+        # Inverted indexes: genre/actor/director name -> sorted list of movie ids.
+        self._movie_ids_by_genre = dict()
+        self._movie_ids_by_actor = dict()
+        self._movie_ids_by_director = dict()
+
+        # User name / movie title -> the reviews they wrote / it got, in the order they were added.
+        self._reviews_by_user = dict()
+        self._reviews_by_movie = dict()
+
+        # (kind, title or name) -> ReviewAggregate, updated by add_review.
+        self._review_aggregates = dict()
+
+        # Typed numeric columns for vectorised filters, sorts and top-N queries.
+        self.movie_columns = MovieColumnStore()
+
+        # Full-text index over titles, descriptions and reviews. Built by the first search, so loading the
+        # catalog does not pay for it, and kept up to date by add_movie_record and add_review after that.
+        # Views run on several threads, so the index is only built, updated and searched under the lock.
+        self._text_index = None
+        self._text_index_lock = threading.Lock()
+
+        # kind -> (lower-cased names in sorted order, the names in the same order). Built by the first
+        # completion of that kind, and kept sorted by add_actor, add_director and add_genre after that.
+        self._name_completions = dict()
 
     def add_actor(self, actor: Actor):
-        if actor not in self.dataset_of_actors:
+        if actor.actor_full_name not in self._actors_by_name:
+            self._actors_by_name[actor.actor_full_name] = actor
             self.dataset_of_actors.append(actor)
+            self._add_name_completion('actor', actor.actor_full_name)
 
     def add_director(self, director: Director):
-        if director not in self.dataset_of_directors:
+        if director.director_full_name not in self._directors_by_name:
+            self._directors_by_name[director.director_full_name] = director
             self.dataset_of_directors.append(director)
+            self._add_name_completion('director', director.director_full_name)
 
     def add_genre(self, genre: Genre):
-        if genre not in self.dataset_of_genres:
+        if genre.genre_name not in self._genres_by_name:
+            self._genres_by_name[genre.genre_name] = genre
             self.dataset_of_genres.append(genre)
+            self._add_name_completion('genre', genre.genre_name)
+
+    def get_names_starting_with(self, kind, prefix, limit=10):
+        if kind not in NAME_KINDS:
+            raise ValueError('Unknown kind of name: {}'.format(kind))
+        if kind not in self._name_completions:
+            names_by_kind = {'actor': self._actors_by_name, 'director': self._directors_by_name,
+                             'genre': self._genres_by_name}
+            names = sorted(names_by_kind[kind], key=str.lower)
+            self._name_completions[kind] = ([name.lower() for name in names], names)
+        keys, names = self._name_completions[kind]
+        prefix = prefix.lower()
+        start = bisect_left(keys, prefix)
+        completions = []
+        for position in range(start, min(start + limit, len(keys))):
+            if not keys[position].startswith(prefix):
+                break
+            completions.append(names[position])
+        return completions
+
+    def _add_name_completion(self, kind, name):
+        if kind in self._name_completions:
+            keys, names = self._name_completions[kind]
+            position = bisect_right(keys, name.lower())
+            keys.insert(position, name.lower())
+            names.insert(position, name)
 
     def add_movie(self, id,title, year,description,director,actor,genre,runtime,rating,revenue,meta, vote):
+        actor_names = [a.strip() for a in actor.split(",")]
+        genre_names = [g.strip() for g in genre.split(",")]
+        self.add_movie_record(id, title, year, description, director, actor_names, genre_names, runtime, rating, revenue, meta, vote)
+
+    def add_movie_record(self, id, title, year, description, director, actor_names, genre_names, runtime, rating, revenue, meta, vote):
+        # Same as add_movie, but with the actor and genre names already split, as produced by movie_records.
         movie = Movie(title,year)
         movie.description = description
-        movie.director = [Director(director)]
-        actors = actor.split(",")
-        for a in actors:
-            movie.add_actor(Actor(a.strip()))
-        genres = genre.split(",")
-        for g in genres:
-            movie.add_genre(Genre(g))
+        movie.director = [self._director_named(director)]
+        for a in actor_names:
+            movie.add_actor(self._actor_named(a))
+        for g in genre_names:
+            movie.add_genre(self._genre_named(g))
         movie.runtime = runtime
+        movie.runtime_minutes = int(runtime)
         movie.rating = rating
         if revenue != "N/A":
             movie.revenue = float(revenue)
@@ -48,51 +127,259 @@ class MemoryRepository(AbstractRepository):
             movie.meta = int(meta)
         movie.vote = vote
         self.dataset_of_movies.append(movie)
-        movie.id = id
+        # Titles are not unique, so each title maps to its movies in insertion order.
+        self._movies_by_title.setdefault(title, []).append(movie)
+        movie.id = int(id)
+        self._movies_by_id[movie.id] = movie
+        add_to_sorted_ids(self._movie_ids, movie.id)
+        self.movie_columns.add(movie.id, year, rating, runtime, revenue, meta, vote)
+
+        for d in movie.director:
+            add_to_posting_list(self._movie_ids_by_director, d.director_full_name, movie.id)
+        for a in movie.actors:
+            add_to_posting_list(self._movie_ids_by_actor, a.actor_full_name, movie.id)
+        for g in movie.genres:
+            add_to_posting_list(self._movie_ids_by_genre, g.genre_name, movie.id)
+        with self._text_index_lock:
+            if self._text_index is not None:
+                index_movie_text(self._text_index, movie, self._reviews_by_movie.get(movie.title, []))
+
+    # The registry hands out one canonical object per name, so every movie shares
+    # the same Actor/Director/Genre and their reviews and ratings stay consistent.
+    def _actor_named(self, actor_name) -> Actor:
+        actor = self._actors_by_name.get(actor_name)
+        if actor is None:
+            actor = Actor(actor_name)
+            self.add_actor(actor)
+        return actor
+
+    def _director_named(self, director_name) -> Director:
+        director = self._directors_by_name.get(director_name)
+        if director is None:
+            director = Director(director_name)
+            self.add_director(director)
+        return director
+
+    def _genre_named(self, genre_name) -> Genre:
+        genre = self._genres_by_name.get(genre_name)
+        if genre is None:
+            genre = Genre(genre_name)
+            self.add_genre(genre)
+        return genre
 
     def add_user(self, user: User):
         self.users.append(user)
+        self._users_by_name.setdefault(user.user_name, user)
 
     def add_review(self, review: Review):
         self.reviews.append(review)
+        self._reviews_by_user.setdefault(review.user, []).append(review)
+        if review.movie is not None:
+            self._reviews_by_movie.setdefault(review.movie, []).append(review)
+        reviewed = {'movie': self.get_movie, 'director': self.get_director,
+                    'genre': self.get_genre, 'actor': self.get_actor}
+        for kind, key in review.subjects():
+            subject = reviewed[kind](key)
+            if subject is not None:
+                subject.add_review(review)
+            if kind == 'movie':
+                # Reviews name their movie by title, so as in the database, every movie with the title is
+                # found by the review's text.
+                with self._text_index_lock:
+                    if self._text_index is not None:
+                        for movie in self._movies_by_title.get(key, []):
+                            self._text_index.add(movie.id, 'reviews', review.review_text)
+            aggregate = self._review_aggregates.get((kind, key))
+            if aggregate is None:
+                aggregate = self._review_aggregates[(kind, key)] = ReviewAggregate(kind, key)
+            aggregate.add(review)
+        for listener in self.review_listeners:
+            listener(review.subjects())
+
+    def find_reviews(self, user=None, movie=None, offset=0, limit=None):
+        if user is None and movie is None:
+            reviews = self.reviews
+        elif movie is None:
+            reviews = self._reviews_by_user.get(user, [])
+        elif user is None:
+            reviews = self._reviews_by_movie.get(movie, [])
+        else:
+            reviews = [review for review in self._reviews_by_movie.get(movie, []) if review.user == user]
+        end = len(reviews) if limit is None else offset + limit
+        return reviews[offset:end], len(reviews)
+
+    def get_review_aggregate(self, kind, key) -> ReviewAggregate:
+        return self._review_aggregates.get((kind, key))
+
+    def get_review_aggregates(self, kind, keys):
+        return {key: self._review_aggregates[(kind, key)] for key in keys if (kind, key) in self._review_aggregates}
+
+    def get_top_rated(self, kind, limit=10):
+        rated = (aggregate for aggregate in self._review_aggregates.values()
+                 if aggregate.kind == kind and aggregate.rating_mean is not None)
+        return nsmallest(limit, rated, key=lambda aggregate: (-aggregate.rating_mean, aggregate.key))
 
     def get_actor(self, actor_name) -> Actor:
-        return next((actor for actor in self.dataset_of_actors if actor.actor_full_name == actor_name), None)
+        return self._actors_by_name.get(actor_name)
 
     def get_director(self, director_name) -> Director:
-        return next((director for director in self.dataset_of_directors if director.director_full_name == director_name), None)
+        return self._directors_by_name.get(director_name)
 
-    def get_genre(self, genre_name) -> Director:
-        return next((genre for genre in self.dataset_of_genres if genre.genre_name == genre_name), None)
+    def get_genre(self, genre_name) -> Genre:
+        return self._genres_by_name.get(genre_name)
 
-    def get_movie(self, title) -> Movie:
-        return next((movie for movie in self.dataset_of_movies if movie.title == title), None)
+    def get_movie(self, title, load=()) -> Movie:
+        movies = self._movies_by_title.get(title)
+        if not movies:
+            return None
+        return movies[0]
 
     def get_user(self, user_name) -> User:
-        return next((user for user in self.users if user.user_name == user_name.lower()), None)
+        return self._users_by_name.get(user_name.lower())
 
     def get_review(self):
         return self.reviews
 
-    def get_dataset_of_movies(self):
+    def get_dataset_of_movies(self, load=()):
         return self.dataset_of_movies
 
+    def get_movies_by_ids(self, ids, load=()):
+        return [self._movies_by_id[movie_id] for movie_id in ids if movie_id in self._movies_by_id]
 
-def read_csv_file(filename: str, repo: MemoryRepository):
-    with open(filename, mode='r', encoding='utf-8-sig') as csvfile:
-        reader = csv.DictReader(csvfile)
+    def find_movie_ids(self, genres=(), actors=(), director=None, offset=0, limit=None):
+        directors = () if director is None else (director,)
+        movie_ids = self._matching_movie_ids(genres, actors, directors)
+        end = len(movie_ids) if limit is None else offset + limit
+        return movie_ids[offset:end], len(movie_ids)
+
+    def iter_movie_ids(self, genres=(), actors=(), director=None, offset=0):
+        directors = () if director is None else (director,)
+        return islice(self._matching_movie_ids(genres, actors, directors), offset, None)
+
+    def find_movies(self, genres=(), actors=(), director=None, offset=0, limit=None, load=()):
+        movie_ids, movie_count = self.find_movie_ids(genres, actors, director, offset, limit)
+        return self.get_movies_by_ids(movie_ids), movie_count
+
+    def get_movie_ids_by_values(self, ranges=None, order_by=None, descending=False, limit=None):
+        return self.movie_columns.select(ranges, order_by, descending, limit)
+
+    def search_movies(self, query, offset=0, limit=None, load=()):
+        with self._text_index_lock:
+            if self._text_index is None:
+                text_index = MovieTextIndex()
+                for movie in self.dataset_of_movies:
+                    index_movie_text(text_index, movie, self._reviews_by_movie.get(movie.title, []))
+                self._text_index = text_index
+            movie_ids = self._text_index.search(parse_query(query))
+        end = len(movie_ids) if limit is None else offset + limit
+        return self.get_movies_by_ids(movie_ids[offset:end]), len(movie_ids)
+
+    def _matching_movie_ids(self, genres, actors, directors):
+        # Returns a sorted id list that must not be modified by the caller.
+        posting_lists = []
+        for index, names in ((self._movie_ids_by_genre, genres),
+                             (self._movie_ids_by_actor, actors),
+                             (self._movie_ids_by_director, directors)):
+            for name in names:
+                posting_lists.append(index.get(name, []))
+        if not posting_lists:
+            return self._movie_ids
+        return intersect_posting_lists(posting_lists)
+
+
+def index_movie_text(index: MovieTextIndex, movie: Movie, reviews):
+    index.add(movie.id, 'title', movie.title)
+    index.add(movie.id, 'description', movie.description)
+    for review in reviews:
+        index.add(movie.id, 'reviews', review.review_text)
+
+
+def add_to_sorted_ids(movie_ids: list, movie_id: int):
+    # Movies are usually loaded in id order, so appending is the common case.
+    if not movie_ids or movie_ids[-1] < movie_id:
+        movie_ids.append(movie_id)
+    else:
+        position = bisect_left(movie_ids, movie_id)
+        if position == len(movie_ids) or movie_ids[position] != movie_id:
+            movie_ids.insert(position, movie_id)
+
+
+def add_to_posting_list(index: dict, name, movie_id: int):
+    add_to_sorted_ids(index.setdefault(name, []), movie_id)
+
+
+def intersect_posting_lists(posting_lists):
+    # Intersect smallest-first, probing the longer lists by binary search, so the
+    # cost follows the rarest name rather than the size of the catalog.
+    posting_lists = sorted(posting_lists, key=len)
+    result = list(posting_lists[0])
+    for posting_list in posting_lists[1:]:
+        if not result:
+            break
+        matches = []
+        position = 0
+        for movie_id in result:
+            position = bisect_left(posting_list, movie_id, position)
+            if position == len(posting_list):
+                break
+            if posting_list[position] == movie_id:
+                matches.append(movie_id)
+        result = matches
+    return result
+
+
+def movie_records(filename: str):
+    # Streams the CSV in a single pass, yielding one add_movie_record argument tuple per row.
+    with open(filename, mode='r', encoding='utf-8-sig', newline='') as csvfile:
+        reader = csv.reader(csvfile)
+        header = next(reader, None)
+        if header is None:
+            return
+        column = {name: index for index, name in enumerate(header)}
+        rank, title, year = column['Rank'], column['Title'], column['Year']
+        description, director, actors, genres = column['Description'], column['Director'], column['Actors'], column['Genre']
+        runtime, rating, revenue = column['Runtime (Minutes)'], column['Rating'], column['Revenue (Millions)']
+        meta, votes = column['Metascore'], column['Votes']
+        # Names repeat across rows; sharing one string per name keeps records (and snapshots) small.
+        names = dict()
         for row in reader:
-            if row == 0:
+            if not row:
                 continue
-            repo.add_movie(row['Rank'],row["Title"], int(row["Year"]), row["Description"], row["Director"],row["Actors"], row["Genre"], row["Runtime (Minutes)"], row["Rating"], row["Revenue (Millions)"], row["Metascore"], row["Votes"])
+            yield (row[rank], row[title], int(row[year]), row[description],
+                   names.setdefault(row[director], row[director]),
+                   [names.setdefault(a, a) for a in (a.strip() for a in row[actors].split(","))],
+                   [names.setdefault(g, g) for g in (g.strip() for g in row[genres].split(","))],
+                   row[runtime], row[rating], row[revenue], row[meta], row[votes])
+
+
+def read_csv_file(filename: str, repo: MemoryRepository):
+    # add_movie_record registers the movie's actors, director and genres with the repository.
+    for record in movie_records(filename):
+        repo.add_movie_record(*record)
 
-            actors = row["Actors"].split(",")
-            for a in actors:
-                repo.add_actor(Actor(a.strip()))
 
-            director = row["Director"]
-            repo.add_director(Director(director))
+def load_movies(filename: str, repo: MemoryRepository, snapshot_path: str = None):
+    # Loads the movies of the CSV into repo, from the snapshot at snapshot_path when it is up to date
+    # with the CSV. Otherwise the CSV is parsed and, if snapshot_path is given, a new snapshot written.
+    # Loading allocates millions of long-lived objects and no garbage cycles, so the cyclic
+    # collector is paused instead of repeatedly scanning the growing catalog.
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        if snapshot_path is None:
+            read_csv_file(filename, repo)
+            return
 
-            genres = row["Genre"].split(",")
-            for g in genres:
-                repo.add_genre(Genre(g))
+        records = snapshot.load_snapshot(snapshot_path, filename)
+        if records is None:
+            records = list(movie_records(filename))
+            try:
+                snapshot.write_snapshot(snapshot_path, filename, records)
+            except OSError:
+                # A read-only data directory only costs the next start its fast path.
+                pass
+        for record in records:
+            repo.add_movie_record(*record)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
@@ -1,6 +1,6 @@
 from sqlalchemy import (
-    Table, MetaData, Column, Integer, String, Date, DateTime,
-    ForeignKey, VARCHAR
+    Table, MetaData, Column, Integer, Float, String, Date, DateTime,
+    ForeignKey, VARCHAR, UniqueConstraint, Index
 )
 from sqlalchemy.orm import mapper, relationship
 
@@ -8,6 +8,17 @@ from movie_web_app.domain import model
 
 metadata = MetaData()
 
+# Databases built with older versions of these tables are brought up to date in place, keeping their data,
+# by database_repository.migrate_schema. It only adds: tables, indexes and columns. A column added to an
+# existing table must be nullable or have a server_default.
+
+# Records how the database was built: a fingerprint of the CSV it was populated from.
+schema_info = Table(
+    'schema_info', metadata,
+    Column('key', String(64), primary_key=True),
+    Column('value', String(1024), nullable=False)
+)
+
 users = Table(
     'users', metadata,
     Column('id', Integer, primary_key=True, autoincrement=True),
@@ -18,19 +29,34 @@ users = Table(
 reviews = Table(
     'reviews', metadata,
     Column('id', Integer, primary_key=True, autoincrement=True),
-    Column('user', String(1024), nullable=False),
-    Column('movie', ForeignKey('movies.title')),
-    Column('actors',ForeignKey('actors.actor_full_name')),
-    Column('genres',ForeignKey('genres.genre_name')),
-    Column('directors',ForeignKey('directors.director_full_name')),
+    Column('user', String(1024), nullable=False, index=True),
+    Column('movie', ForeignKey('movies.title'), index=True),
+    Column('actors',ForeignKey('actors.actor_full_name'), index=True),
+    Column('genres',ForeignKey('genres.genre_name'), index=True),
+    Column('directors',ForeignKey('directors.director_full_name'), index=True),
     Column('review', String(1024), nullable=False),
     Column('timestamp', DateTime, nullable=True),
     Column('rating', Integer,nullable=True)
 )
+
+# Rating totals per reviewed movie, director, genre and actor (kind), keyed by title or name, updated in the
+# transaction that inserts the reviews. The (kind, rating_mean) index serves top-rated lists.
+review_aggregates = Table(
+    'review_aggregates', metadata,
+    Column('kind', String(16), primary_key=True),
+    Column('key', String(255), primary_key=True),
+    Column('rating_sum', Integer, nullable=False),
+    Column('rating_count', Integer, nullable=False),
+    Column('rating_mean', Float, nullable=True),
+    Column('review_count', Integer, nullable=False, server_default='0'),
+    Column('last_reviewed', DateTime, nullable=True),
+    Index('ix_review_aggregates_kind_rating_mean', 'kind', 'rating_mean')
+)
+
 movies = Table(
     'movies', metadata,
     Column('id', Integer, primary_key=True, autoincrement=True),
-    Column('title', String(255), nullable=False),
+    Column('title', String(255), nullable=False, index=True),
     Column('description', String(2048), nullable=False),
     Column('time', Integer, nullable=False),
     Column('runtime', String(1024), nullable=False),
@@ -41,11 +67,11 @@ movies = Table(
     Column('add_url', String(255), nullable=True)
 )
 
+# One row per director, actor and genre. Their movies are linked through the junction tables below.
 directors = Table(
     'directors', metadata,
     Column('id', Integer, primary_key=True, autoincrement=True),
-    Column('movie', ForeignKey('movies.title')),
-    Column('director_full_name', String(255),nullable=False),
+    Column('director_full_name', String(255), nullable=False, unique=True),
     Column('rating', Integer, nullable=True),
     Column('rating_num',Integer, nullable=True),
     Column('add_url', String(255), nullable=True)
@@ -54,8 +80,7 @@ directors = Table(
 actors = Table(
     'actors', metadata,
     Column('id', Integer, primary_key=True, autoincrement=True),
-    Column('movie', ForeignKey('movies.title')),
-    Column('actor_full_name', String(255),nullable=False),
+    Column('actor_full_name', String(255), nullable=False, unique=True),
     Column('rating', Integer, nullable=True),
     Column('rating_num',Integer, nullable=True),
     Column('add_url', String(255), nullable=True)
@@ -64,13 +89,48 @@ actors = Table(
 genres = Table(
     'genres', metadata,
     Column('id', Integer, primary_key=True, autoincrement=True),
-    Column('movie', ForeignKey('movies.title')),
-    Column('genre_name', String(255),nullable=False),
+    Column('genre_name', String(255), nullable=False, unique=True),
     Column('rating', Integer, nullable=True),
     Column('rating_num',Integer, nullable=True),
     Column('add_url', String(255), nullable=True)
 )
 
+# Case-insensitive name indexes. They serve prefix lookups (name LIKE 'prefix%', which ignores case) as a
+# range scan, in alphabetical order.
+Index('ix_directors_director_full_name_nocase', directors.c.director_full_name.collate('NOCASE'))
+Index('ix_actors_actor_full_name_nocase', actors.c.actor_full_name.collate('NOCASE'))
+Index('ix_genres_genre_name_nocase', genres.c.genre_name.collate('NOCASE'))
+
+# Junction tables. The id keeps the CSV order of a movie's credits; the unique (movie, entity) index
+# serves a movie's credits and the (entity, movie) index serves filmographies, both without
+# touching the table rows.
+movie_directors = Table(
+    'movie_directors', metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('movie_id', ForeignKey('movies.id'), nullable=False),
+    Column('director_id', ForeignKey('directors.id'), nullable=False),
+    UniqueConstraint('movie_id', 'director_id'),
+    Index('ix_movie_directors_director_id_movie_id', 'director_id', 'movie_id')
+)
+
+movie_actors = Table(
+    'movie_actors', metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('movie_id', ForeignKey('movies.id'), nullable=False),
+    Column('actor_id', ForeignKey('actors.id'), nullable=False),
+    UniqueConstraint('movie_id', 'actor_id'),
+    Index('ix_movie_actors_actor_id_movie_id', 'actor_id', 'movie_id')
+)
+
+movie_genres = Table(
+    'movie_genres', metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('movie_id', ForeignKey('movies.id'), nullable=False),
+    Column('genre_id', ForeignKey('genres.id'), nullable=False),
+    UniqueConstraint('movie_id', 'genre_id'),
+    Index('ix_movie_genres_genre_id_movie_id', 'genre_id', 'movie_id')
+)
+
 
 def map_model_to_tables():
     mapper(model.User, users, properties={
@@ -83,12 +143,16 @@ def map_model_to_tables():
         'user': reviews.c.user,
         'rating': reviews.c.rating
     })
+    mapper(model.ReviewAggregate, review_aggregates)
     mapper(model.Movie, movies, properties={
         'title': movies.c.title,
         'description': movies.c.description,
-        'director': relationship(model.Director, backref='directors'),
-        'genres': relationship(model.Genre, backref='genres'),
-        'actors': relationship(model.Actor, backref='actors'),
+        'director': relationship(model.Director, secondary=movie_directors,
+                                 order_by=movie_directors.c.id, backref='movies'),
+        'genres': relationship(model.Genre, secondary=movie_genres,
+                               order_by=movie_genres.c.id, backref='movies'),
+        'actors': relationship(model.Actor, secondary=movie_actors,
+                               order_by=movie_actors.c.id, backref='movies'),
         'time':movies.c.time,
         'runtime_minutes': movies.c.runtime,
         'rating':movies.c.rating,
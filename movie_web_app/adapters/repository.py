@@ -1,12 +1,21 @@
 # repository.py
 import abc
-from typing import List
+from typing import Dict, Iterator, List, Tuple
 
-from movie_web_app.domain.model import Actor, Director, Genre, Movie, Review, User
+from movie_web_app.domain.model import Actor, Director, Genre, Movie, Review, ReviewAggregate, User
 
 
 repo_instance = None
 
+# A loading plan names the relationships of the Movies a caller is about to use, so that a repository
+# which loads them lazily can fetch them for all of the Movies in a constant number of queries.
+MOVIE_RELATIONSHIPS = ('director', 'genres', 'actors', 'review')
+# Everything a page of movies shows: credits, genres and reviews.
+MOVIE_LISTING = MOVIE_RELATIONSHIPS
+
+# The kinds of names get_names_starting_with completes.
+NAME_KINDS = ('actor', 'director', 'genre')
+
 class AbstractRepository(abc.ABC):
 
     @abc.abstractmethod
@@ -42,15 +51,21 @@ class AbstractRepository(abc.ABC):
         # If there is no Genre with the given genre_name, this method returns None.
         raise NotImplementedError
 
+    @abc.abstractmethod
+    def get_names_starting_with(self, kind, prefix, limit=10) -> List[str]:
+        # Returns the names of the actors, directors or genres (kind is one of NAME_KINDS) that start with
+        # prefix, ignoring case, in alphabetical order and at most limit of them.
+        raise NotImplementedError
+
     @abc.abstractmethod
     def add_movie(self, id, title, year, description, director, actor, genre, runtime, rating,revenue,meta,vote):
         # Adds an movie to repository
         raise NotImplementedError
 
     @abc.abstractmethod
-    def get_movie(self, movie_name) -> Movie:
-        # Returns the Movie named movie_name from the repository.
-        # If there is no Movie with the given movie_name, this method returns None.
+    def get_movie(self, movie_name, load=()) -> Movie:
+        # Returns the Movie named movie_name from the repository, with the relationships in the loading
+        # plan load already fetched. If there is no Movie with the given movie_name, this method returns None.
         raise NotImplementedError
 
     @abc.abstractmethod
@@ -67,6 +82,8 @@ class AbstractRepository(abc.ABC):
     @abc.abstractmethod
     def add_review(self, review: Review):
         # Adds an genre to repository
+        # Once added reviews can be read back, implementations call every function in their review_listeners
+        # list with the (kind, name) subjects of those reviews, as given by Review.subjects().
         raise NotImplementedError
 
     @abc.abstractmethod
@@ -75,4 +92,72 @@ class AbstractRepository(abc.ABC):
         # If there is no Genre with the given genre_name, this method returns None.
         raise NotImplementedError
 
+    @abc.abstractmethod
+    def find_reviews(self, user=None, movie=None, offset=0, limit=None) -> Tuple[List[Review], int]:
+        # Returns the Reviews written by user, if one is named, of the movie titled movie, if one is named,
+        # in the order they were added, skipping the first offset and returning at most limit of them,
+        # together with the total number of matching Reviews.
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_review_aggregate(self, kind, key) -> ReviewAggregate:
+        # Returns the ReviewAggregate of the movie titled key, or of the director, genre or actor named key,
+        # as kind says ('movie', 'director', 'genre' or 'actor'). Returns None if it has never been reviewed.
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_review_aggregates(self, kind, keys) -> Dict[str, ReviewAggregate]:
+        # Returns the ReviewAggregates of kind for the keys, by key, in one go. Keys never reviewed are left out.
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_top_rated(self, kind, limit=10) -> List[ReviewAggregate]:
+        # Returns the ReviewAggregates of kind with the highest mean rating, at most limit of them,
+        # ties ordered by key. Anything without a rated review is left out.
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_dataset_of_movies(self, load=()) -> List[Movie]:
+        # Returns every Movie in the repository, with the relationships in the loading plan load fetched.
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_movies_by_ids(self, ids, load=()) -> List[Movie]:
+        # Returns the Movies with the given ids, in the order of ids. Unknown ids are skipped.
+        # The relationships in the loading plan load are fetched for all of them.
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def find_movie_ids(self, genres=(), actors=(), director=None, offset=0, limit=None) -> Tuple[List[int], int]:
+        # Same as find_movies, but returns the ids of the Movies on the page instead of the Movies.
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def iter_movie_ids(self, genres=(), actors=(), director=None, offset=0) -> Iterator[int]:
+        # Yields the ids of the Movies find_movies would find, in order and skipping the first offset, reading
+        # them as they are asked for, so that all of them can be gone through without holding them at once.
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def find_movies(self, genres=(), actors=(), director=None, offset=0, limit=None, load=()) -> Tuple[List[Movie], int]:
+        # Returns the Movies that have all of the given genres and actors, and the given director if one is
+        # named, ordered by id, skipping the first offset and returning at most limit of them, together with
+        # the total number of matching Movies. The relationships in the loading plan load are fetched for
+        # the returned Movies.
+        raise NotImplementedError
 
+    @abc.abstractmethod
+    def search_movies(self, query, offset=0, limit=None, load=()) -> Tuple[List[Movie], int]:
+        # Returns the Movies whose title, description and reviews contain every word and "quoted phrase"
+        # of query, best match first, skipping the first offset and returning at most limit of them,
+        # together with the total number of matching Movies. Words match regardless of case and accents.
+        # The relationships in the loading plan load are fetched for the returned Movies.
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_movie_ids_by_values(self, ranges=None, order_by=None, descending=False, limit=None) -> List[int]:
+        # Returns the ids of the movies whose numeric attributes ('time', 'rating', 'runtime_minutes', 'revenue',
+        # 'meta' or 'vote') fall inside each inclusive (low, high) range in ranges; either bound may be None.
+        # Ids are ordered by the order_by attribute, missing values last and ties by id, or else by id,
+        # and at most limit ids are returned.
+        raise NotImplementedError
@@ -0,0 +1,75 @@
+# snapshot.py
+import hashlib
+import json
+import mmap
+import os
+import pickle
+import struct
+
+# A snapshot is MAGIC, a 4-byte header length, a JSON header describing the source CSV, then a pickle
+# of the parsed movie records. Bump FORMAT_VERSION whenever the record layout changes.
+MAGIC = b'MOVIESNAP\n'
+FORMAT_VERSION = 1
+HEADER_LENGTH = struct.Struct('>I')
+
+
+def file_fingerprint(filename: str, with_hash=True):
+    stat = os.stat(filename)
+    fingerprint = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if with_hash:
+        fingerprint['sha1'] = file_hash(filename)
+    return fingerprint
+
+
+def file_hash(filename: str):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as infile:
+        for block in iter(lambda: infile.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def write_snapshot(snapshot_path: str, source_filename: str, records):
+    header = json.dumps({'version': FORMAT_VERSION, 'source': file_fingerprint(source_filename)}).encode('utf-8')
+    temporary_path = '{}.{}.tmp'.format(snapshot_path, os.getpid())
+    with open(temporary_path, 'wb') as outfile:
+        outfile.write(MAGIC)
+        outfile.write(HEADER_LENGTH.pack(len(header)))
+        outfile.write(header)
+        pickle.dump(records, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+    # Replace in one step so a concurrently starting worker never sees a half-written snapshot.
+    os.replace(temporary_path, snapshot_path)
+
+
+def load_snapshot(snapshot_path: str, source_filename: str):
+    # Returns the records stored in the snapshot, or None if there is no usable snapshot for the
+    # current contents of source_filename.
+    try:
+        with open(snapshot_path, 'rb') as infile:
+            with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if mapped[:len(MAGIC)] != MAGIC:
+                    return None
+                offset = len(MAGIC)
+                (header_length,) = HEADER_LENGTH.unpack_from(mapped, offset)
+                offset += HEADER_LENGTH.size
+                header = json.loads(mapped[offset:offset + header_length].decode('utf-8'))
+                if header.get('version') != FORMAT_VERSION or not matches_source(header['source'], source_filename):
+                    return None
+                with memoryview(mapped) as view:
+                    payload = view[offset + header_length:]
+                    try:
+                        return pickle.loads(payload)
+                    finally:
+                        payload.release()
+    except (OSError, ValueError, KeyError, struct.error, pickle.UnpicklingError, EOFError):
+        return None
+
+
+def matches_source(recorded, source_filename: str):
+    current = file_fingerprint(source_filename, with_hash=False)
+    if current['size'] != recorded['size']:
+        return False
+    if current['mtime_ns'] == recorded['mtime_ns']:
+        return True
+    # Same size but touched or copied: only the content hash can tell.
+    return file_hash(source_filename) == recorded['sha1']
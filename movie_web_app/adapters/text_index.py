@@ -0,0 +1,142 @@
+# text_index.py
+import math
+import re
+import unicodedata
+
+
+# The text searched for each movie, and the weight of a match in each when ranking. The database
+# backend's movie_search FTS5 table has the same columns and passes the same weights to bm25().
+SEARCH_FIELDS = ('title', 'description', 'reviews')
+SEARCH_WEIGHTS = (10.0, 1.0, 2.0)
+
+TOKEN = re.compile(r'[^\W_]+')
+
+
+def tokenize(text: str):
+    # Lower-cased words with diacritics removed, split as SQLite's unicode61 tokenizer (remove_diacritics 2)
+    # splits them, so both backends see the same tokens.
+    text = text.lower()
+    if not text.isascii():
+        text = unicodedata.normalize('NFKD', text)
+        text = ''.join(character for character in text if not unicodedata.combining(character))
+    return TOKEN.findall(text)
+
+
+def parse_query(query: str):
+    # Splits a search query into phrases, each a tuple of tokens. "Quoted text" is one phrase, and so is
+    # every other whitespace-separated word (a hyphenated word is a phrase of its parts).
+    # A movie matches the query if it contains all of the phrases.
+    phrases = []
+    for i, part in enumerate(query.split('"')):
+        chunks = [part] if i % 2 == 1 else part.split()
+        for chunk in chunks:
+            tokens = tuple(tokenize(chunk))
+            if tokens:
+                phrases.append(tokens)
+    return phrases
+
+
+class MovieTextIndex:
+    # An inverted index over the title, description and reviews of each movie. Every token keeps its
+    # positions so phrases can be matched, and matches are ranked with BM25 the way FTS5's bm25() does.
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self):
+        # One inverted index per field: token -> {movie id: positions of the token in the field}
+        self._postings = tuple(dict() for _ in SEARCH_FIELDS)
+        # movie id -> number of tokens per field
+        self._lengths = dict()
+        self._total_tokens = 0
+
+    def __len__(self):
+        return len(self._lengths)
+
+    def add(self, movie_id: int, field: str, text: str):
+        # Appends text to the field of the movie, after whatever was indexed there before.
+        field_index = SEARCH_FIELDS.index(field)
+        lengths = self._lengths.setdefault(movie_id, [0] * len(SEARCH_FIELDS))
+        tokens = tokenize(text)
+        # Gather the positions of each token first, so the shared index is touched once per distinct token.
+        token_positions = dict()
+        for position, token in enumerate(tokens, lengths[field_index]):
+            positions = token_positions.get(token)
+            if positions is None:
+                token_positions[token] = [position]
+            else:
+                positions.append(position)
+
+        postings = self._postings[field_index]
+        for token, positions in token_positions.items():
+            movie_positions = postings.get(token)
+            if movie_positions is None:
+                postings[token] = {movie_id: positions}
+            elif movie_id in movie_positions:
+                movie_positions[movie_id].extend(positions)
+            else:
+                movie_positions[movie_id] = positions
+        lengths[field_index] += len(tokens)
+        self._total_tokens += len(tokens)
+
+    def search(self, phrases):
+        # Returns the ids of the movies containing every phrase, best match first and ties by id.
+        if len(phrases) == 0 or len(self._lengths) == 0:
+            return []
+        phrase_hits = []
+        # Rarest phrase first, so one that matches nothing ends the search before the common ones are read.
+        for phrase in sorted(phrases, key=self._estimated_matches):
+            hits = self._phrase_hits(phrase)
+            if len(hits) == 0:
+                return []
+            phrase_hits.append(hits)
+        smallest = min(phrase_hits, key=len)
+        movie_ids = [movie_id for movie_id in smallest if all(movie_id in hits for hits in phrase_hits)]
+
+        movie_count = len(self._lengths)
+        average_length = self._total_tokens / movie_count
+        idfs = [max(math.log((movie_count - len(hits) + 0.5) / (len(hits) + 0.5)), 1e-6) for hits in phrase_hits]
+        ranked = []
+        for movie_id in movie_ids:
+            length_norm = self.K1 * (1 - self.B + self.B * sum(self._lengths[movie_id]) / average_length)
+            score = 0.0
+            for idf, hits in zip(idfs, phrase_hits):
+                frequency = sum(weight * count for weight, count in zip(SEARCH_WEIGHTS, hits[movie_id]))
+                score += idf * frequency * (self.K1 + 1) / (frequency + length_norm)
+            ranked.append((-score, movie_id))
+        ranked.sort()
+        return [movie_id for _, movie_id in ranked]
+
+    def _estimated_matches(self, phrase):
+        # At least as many movies as contain the phrase: those containing its rarest token.
+        return min(sum(len(postings.get(token, ())) for postings in self._postings) for token in phrase)
+
+    def _phrase_hits(self, phrase):
+        # movie id -> number of occurrences of the phrase in each field, for the movies that contain it.
+        hits = dict()
+        for field_index, postings in enumerate(self._postings):
+            for movie_id, count in phrase_counts(postings, phrase).items():
+                if movie_id not in hits:
+                    hits[movie_id] = [0] * len(SEARCH_FIELDS)
+                hits[movie_id][field_index] = count
+        return hits
+
+
+def phrase_counts(postings, phrase):
+    # movie id -> number of times the tokens of phrase appear one after another, in one field's postings.
+    token_postings = [postings.get(token) for token in phrase]
+    if any(movie_positions is None for movie_positions in token_postings):
+        return {}
+    if len(phrase) == 1:
+        return {movie_id: len(positions) for movie_id, positions in token_postings[0].items()}
+
+    counts = dict()
+    for movie_id, starts in token_postings[0].items():
+        following = [movie_positions.get(movie_id) for movie_positions in token_postings[1:]]
+        if None in following:
+            continue
+        following = [set(positions) for positions in following]
+        count = sum(1 for start in starts
+                    if all(start + i in positions for i, positions in enumerate(following, 1)))
+        if count > 0:
+            counts[movie_id] = count
+    return counts
@@ -0,0 +1,124 @@
+# write_behind.py
+import threading
+
+from movie_web_app.adapters.database_repository import add_reviews
+
+
+class ReviewWriteBehind:
+    # Queues reviews and writes them to the database in batches: one transaction (and one fsync) for
+    # everything queued, written as soon as batch_size reviews are waiting, and otherwise by a
+    # background thread every max_delay seconds. flush(user_name) lets a user's next request see their
+    # own reviews straight away, and close() writes whatever is left on shutdown. A batch that fails
+    # max_attempts times in a row is written one review at a time, and the reviews that still fail are dropped.
+
+    def __init__(self, session_factory, batch_size=50, max_delay=0.5, max_attempts=3):
+        self._session_factory = session_factory
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.batches_written = 0
+        self.reviews_written = 0
+        self.reviews_dropped = 0
+        self._failed_attempts = 0
+        # Functions called with the (kind, name) subjects of each batch once it is committed.
+        self.listeners = []
+
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        # Batches are written one at a time, so reviews reach the database in the order they were added.
+        self._write_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='review-write-behind', daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        with self._pending_lock:
+            return len(self._pending)
+
+    def add(self, review):
+        with self._pending_lock:
+            if self._closed.is_set():
+                raise RuntimeError('The review queue has been closed')
+            self._pending.append(review)
+            full = len(self._pending) >= self.batch_size
+        if full:
+            # The caller writes the batch, which also slows down a burst that outpaces the database. A batch
+            # that fails is still queued, so the review is not lost: the background flush tries again.
+            try:
+                self.flush()
+            except Exception as error:
+                print("REVIEW WRITE-BEHIND FLUSH FAILED: {}".format(error))
+
+    def flush(self, user_name=None):
+        # Writes every queued review. Given a user_name, only does so if that user has a review queued.
+        # Returns the number of reviews written.
+        with self._write_lock:
+            with self._pending_lock:
+                if user_name is not None and not any(review.user == user_name for review in self._pending):
+                    return 0
+                batch, self._pending = self._pending, []
+            if len(batch) == 0:
+                return 0
+            # Read before the commit expires the reviews.
+            subjects_of = {id(review): review.subjects() for review in batch}
+
+            try:
+                self._write(batch)
+                self._failed_attempts = 0
+            except Exception:
+                self._failed_attempts += 1
+                if self._failed_attempts < self.max_attempts:
+                    # Put the batch back in front of anything queued since, so nothing is lost or reordered.
+                    with self._pending_lock:
+                        self._pending[:0] = batch
+                    raise
+                # Retrying the batch whole would fail forever on a review the database rejects, such as one
+                # breaking a constraint, so that review alone is dropped.
+                self._failed_attempts = 0
+                batch = self._write_one_by_one(batch)
+                if len(batch) == 0:
+                    return 0
+
+            self.batches_written += 1
+            self.reviews_written += len(batch)
+            subjects = [subject for review in batch for subject in subjects_of[id(review)]]
+            for listener in self.listeners:
+                listener(subjects)
+            return len(batch)
+
+    def _write(self, reviews):
+        session = self._session_factory()
+        try:
+            add_reviews(session, reviews)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def _write_one_by_one(self, reviews):
+        # Returns the reviews written.
+        written = []
+        for review in reviews:
+            try:
+                self._write([review])
+            except Exception as error:
+                self.reviews_dropped += 1
+                print("REVIEW WRITE-BEHIND DROPPED A REVIEW BY {}: {}".format(review.user, error))
+            else:
+                written.append(review)
+        return written
+
+    def close(self):
+        self._closed.set()
+        self._thread.join()
+        self.flush()
+
+    def _run(self):
+        while not self._closed.wait(self.max_delay):
+            try:
+                self.flush()
+            except Exception as error:
+                # The batch is still queued; the next flush tries again.
+                print("REVIEW WRITE-BEHIND FLUSH FAILED: {}".format(error))
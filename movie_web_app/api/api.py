@@ -0,0 +1,234 @@
+# api.py
+from itertools import islice
+
+from flask import Blueprint, Response, abort, current_app, jsonify, request, stream_with_context, url_for
+from werkzeug.exceptions import HTTPException
+
+import movie_web_app.adapters.repository as repo
+
+# Configure Blueprint.
+api_blueprint = Blueprint('api_bp', __name__, url_prefix='/api')
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+# Items per repository call and per chunk sent when a result set is streamed.
+STREAM_BATCH_SIZE = 200
+NDJSON = 'application/x-ndjson'
+
+
+def number(value, kind=float):
+    # The CSV's numbers are strings in the database, and 'N/A' where missing; both become JSON numbers or null.
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        return None
+
+
+REVIEW_FIELDS = {
+    'user': lambda review: review.user,
+    'movie': lambda review: review.movie,
+    'director': lambda review: review.directors,
+    'genre': lambda review: review.genres,
+    'actor': lambda review: review.actors,
+    'text': lambda review: review.review_text,
+    'rating': lambda review: review.rating,
+    'timestamp': lambda review: review.time_stamp.isoformat() if review.time_stamp is not None else None,
+}
+
+MOVIE_FIELDS = {
+    'id': lambda movie: movie.id,
+    'title': lambda movie: movie.title,
+    'year': lambda movie: movie.time,
+    'description': lambda movie: movie.description,
+    'runtime': lambda movie: number(movie.runtime_minutes, int),
+    'rating': lambda movie: number(movie.rating),
+    'votes': lambda movie: number(movie.vote, int),
+    'revenue': lambda movie: number(movie.revenue),
+    'metascore': lambda movie: number(movie.meta, int),
+    'directors': lambda movie: [director.director_full_name for director in movie.director],
+    'actors': lambda movie: [actor.actor_full_name for actor in movie.actors],
+    'genres': lambda movie: [genre.genre_name for genre in movie.genres],
+    'reviews': lambda movie: [to_dict(review, REVIEW_FIELDS, REVIEW_FIELDS) for review in movie.review],
+}
+# The relationship movies are loaded with for each field that needs one, so only what is sent is read.
+MOVIE_FIELD_LOADS = {'directors': 'director', 'actors': 'actors', 'genres': 'genres', 'reviews': 'review'}
+# Reviews can be many, so they are only sent when asked for.
+DEFAULT_MOVIE_FIELDS = tuple(field for field in MOVIE_FIELDS if field != 'reviews')
+
+# Fields of an actor, director or genre: its name, the totals of its reviews and the reviews themselves.
+NAME_FIELDS = ('name', 'rating', 'rating_count', 'review_count', 'reviews')
+DEFAULT_NAME_FIELDS = ('name', 'rating', 'rating_count', 'review_count')
+# The name fields read from its ReviewAggregate, and the attribute each comes from.
+AGGREGATE_FIELDS = {'rating': 'rating_mean', 'rating_count': 'rating_count', 'review_count': 'review_count'}
+
+
+@api_blueprint.errorhandler(HTTPException)
+def http_error(error):
+    return jsonify(error=error.description), error.code
+
+
+@api_blueprint.route('/movies', methods=['GET'])
+def movies():
+    # Movies with every genre= and actor= and the director= given, by id, or the matches of the full-text
+    # query q=, best first. Paged with offset= and limit=, or streamed in full as NDJSON.
+    query = request.args.get('q')
+    genres = request.args.getlist('genre')
+    actors = request.args.getlist('actor')
+    director = request.args.get('director')
+    if query is not None and (genres or actors or director is not None):
+        abort(400, 'q cannot be combined with genre, actor or director')
+    fields = selected_fields(tuple(MOVIE_FIELDS), DEFAULT_MOVIE_FIELDS)
+    load = tuple(MOVIE_FIELD_LOADS[field] for field in fields if field in MOVIE_FIELD_LOADS)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+
+    if wants_stream():
+        if query is not None:
+            batches = page_batches(
+                lambda offset, limit: repo.repo_instance.search_movies(query, offset=offset, limit=limit, load=load),
+                offset)
+        else:
+            movie_ids = repo.repo_instance.iter_movie_ids(genres, actors, director, offset)
+            batches = (repo.repo_instance.get_movies_by_ids(ids, load) for ids in batched(movie_ids, STREAM_BATCH_SIZE))
+        return stream(batches, MOVIE_FIELDS, fields)
+
+    limit = page_limit()
+    if query is not None:
+        movies, total = repo.repo_instance.search_movies(query, offset=offset, limit=limit, load=load)
+    else:
+        movies, total = repo.repo_instance.find_movies(genres=genres, actors=actors, director=director,
+                                                       offset=offset, limit=limit, load=load)
+    return page('movies', [to_dict(movie, MOVIE_FIELDS, fields) for movie in movies], total, offset, limit)
+
+
+@api_blueprint.route('/movies/<int:movie_id>', methods=['GET'])
+def movie(movie_id):
+    fields = selected_fields(tuple(MOVIE_FIELDS), DEFAULT_MOVIE_FIELDS)
+    load = tuple(MOVIE_FIELD_LOADS[field] for field in fields if field in MOVIE_FIELD_LOADS)
+    movies = repo.repo_instance.get_movies_by_ids([movie_id], load)
+    if len(movies) == 0:
+        abort(404, 'No movie with id {}'.format(movie_id))
+    return jsonify(to_dict(movies[0], MOVIE_FIELDS, fields))
+
+
+@api_blueprint.route('/<any(actors, directors, genres):kinds>', methods=['GET'])
+def names(kinds):
+    # Up to limit= names starting with prefix=, ignoring case, in alphabetical order.
+    kind = kinds[:-1]
+    fields = selected_fields(NAME_FIELDS, DEFAULT_NAME_FIELDS)
+    limit = page_limit()
+    matches = repo.repo_instance.get_names_starting_with(kind, request.args.get('prefix', ''), limit)
+    return jsonify({kinds: [name_to_dict(kind, name, fields) for name in matches]})
+
+
+@api_blueprint.route('/<any(actors, directors, genres):kinds>/<path:name>', methods=['GET'])
+def name(kinds, name):
+    kind = kinds[:-1]
+    fields = selected_fields(NAME_FIELDS, DEFAULT_NAME_FIELDS)
+    if get_named(kind, name) is None:
+        abort(404, 'No {} named {}'.format(kind, name))
+    return jsonify(name_to_dict(kind, name, fields))
+
+
+@api_blueprint.route('/reviews', methods=['GET'])
+def reviews():
+    # Reviews in the order they were written, optionally only those by user= or of the movie=.
+    fields = selected_fields(tuple(REVIEW_FIELDS), tuple(REVIEW_FIELDS))
+    user = request.args.get('user')
+    movie_title = request.args.get('movie')
+    offset = max(request.args.get('offset', 0, type=int), 0)
+
+    def find_reviews(offset, limit):
+        return repo.repo_instance.find_reviews(user=user, movie=movie_title, offset=offset, limit=limit)
+
+    if wants_stream():
+        return stream(page_batches(find_reviews, offset), REVIEW_FIELDS, fields)
+    limit = page_limit()
+    matches, total = find_reviews(offset, limit)
+    return page('reviews', [to_dict(review, REVIEW_FIELDS, fields) for review in matches], total, offset, limit)
+
+
+def selected_fields(fields, default):
+    # The comma-separated fields= of the request, or default if it names none.
+    requested = [field.strip() for field in request.args.get('fields', '').split(',') if field.strip()]
+    unknown = [field for field in requested if field not in fields]
+    if unknown:
+        abort(400, 'Unknown fields {}; choose from {}'.format(', '.join(unknown), ', '.join(fields)))
+    return tuple(requested) if requested else default
+
+
+def page_limit():
+    return min(max(request.args.get('limit', DEFAULT_LIMIT, type=int), 1), MAX_LIMIT)
+
+
+def wants_stream():
+    return request.args.get('format') == 'ndjson' or \
+           request.accept_mimetypes.best_match(['application/json', NDJSON]) == NDJSON
+
+
+def page(key, items, total, offset, limit):
+    next_url = None
+    if offset + limit < total:
+        args = request.args.to_dict(flat=False)
+        args['offset'] = offset + limit
+        next_url = url_for(request.endpoint, **args)
+    return jsonify({key: items, 'total': total, 'offset': offset, 'limit': limit, 'next': next_url})
+
+
+def stream(batches, fields, selected):
+    # One JSON object per line, sent a batch at a time as the batches are read, so neither side holds the whole
+    # result. One encoder serves the whole stream; looking up the app's JSON settings per line costs more than
+    # the encoding.
+    encode = current_app.json_encoder(separators=(',', ':'), sort_keys=current_app.config['JSON_SORT_KEYS']).encode
+
+    def lines():
+        for batch in batches:
+            yield ''.join(encode(to_dict(item, fields, selected)) + '\n' for item in batch)
+
+    return Response(stream_with_context(lines()), mimetype=NDJSON)
+
+
+def batched(items, size):
+    items = iter(items)
+    while True:
+        batch = list(islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+def page_batches(find_page, offset):
+    # Pages of STREAM_BATCH_SIZE items from offset on, read one at a time as they are sent. find_page(offset,
+    # limit) returns a page and the total number of items, as find_reviews and search_movies do.
+    while True:
+        items, total = find_page(offset, STREAM_BATCH_SIZE)
+        yield items
+        offset += len(items)
+        if len(items) == 0 or offset >= total:
+            return
+
+
+def to_dict(item, fields, selected):
+    return {field: fields[field](item) for field in selected}
+
+
+def get_named(kind, name):
+    return getattr(repo.repo_instance, 'get_' + kind)(name)
+
+
+def name_to_dict(kind, name, selected):
+    # The review totals and reviews are only read if a selected field needs them.
+    aggregate = None
+    if any(field in AGGREGATE_FIELDS for field in selected):
+        aggregate = repo.repo_instance.get_review_aggregate(kind, name)
+    result = {}
+    for field in selected:
+        if field == 'name':
+            result[field] = name
+        elif field == 'reviews':
+            result[field] = [to_dict(review, REVIEW_FIELDS, REVIEW_FIELDS) for review in get_named(kind, name).review]
+        elif aggregate is not None:
+            result[field] = getattr(aggregate, AGGREGATE_FIELDS[field])
+        else:
+            # Never reviewed.
+            result[field] = None if field == 'rating' else 0
+    return result
@@ -0,0 +1,121 @@
+# asgi.py
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+
+class AsgiAdapter:
+    # Serves the Flask (WSGI) app to an ASGI server. Requests are read and answered on the event loop,
+    # and only the Flask view itself runs on a bounded pool of worker threads, so a single process can
+    # hold hundreds of requests in flight while at most max_workers of them use a thread and a
+    # database connection at once.
+
+    def __init__(self, wsgi_app, max_workers=8):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            await self.handle_http(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self.handle_lifespan(receive, send)
+        else:
+            raise ValueError('Unsupported ASGI scope type: {}'.format(scope['type']))
+
+    async def handle_lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                # Waited for off the event loop: a worker still sending a response needs the loop to finish.
+                await asyncio.get_running_loop().run_in_executor(None, partial(self.executor.shutdown, wait=True))
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def handle_http(self, scope, receive, send):
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b'')
+            if not message.get('more_body', False):
+                break
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.run_wsgi_app, wsgi_environ(scope, bytes(body)), loop, send)
+
+    def run_wsgi_app(self, environ, loop, send):
+        # Runs on a worker thread. Response messages are passed back to the event loop as the app
+        # produces them, so a streamed response is sent chunk by chunk.
+        def send_message(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and response.get('started'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                   for name, value in headers]
+
+        def start_once():
+            if not response.get('started'):
+                response['started'] = True
+                send_message({'type': 'http.response.start', 'status': response['status'],
+                              'headers': response['headers']})
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            for chunk in result:
+                start_once()
+                if chunk:
+                    send_message({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            start_once()
+            send_message({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+
+def wsgi_environ(scope, body):
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        # WSGI carries paths as bytes decoded with latin-1.
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[name] = value
+            continue
+        key = 'HTTP_' + name
+        if key in environ:
+            # Cookies are separated as in a single Cookie header, any other repeated header as a list.
+            value = environ[key] + ('; ' if key == 'HTTP_COOKIE' else ', ') + value
+        environ[key] = value
+
+    # The body has been read in full, so its length is known even if the client sent it chunked.
+    environ['CONTENT_LENGTH'] = str(len(body))
+    return environ
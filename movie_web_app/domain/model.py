@@ -3,10 +3,28 @@
 from datetime import time,datetime
 
 
-class Actor:
+# Shared stand-in for the review collection of anything that has not been reviewed yet.
+NO_REVIEWS = ()
+
+
+class Reviewable:
+    # Most movies, people and genres are never reviewed, so instead of giving each one its own
+    # empty list, review falls back to NO_REVIEWS until add_review creates the list.
+    # When the class is mapped by the ORM, review is a relationship and this fallback is never reached.
+    def __getattr__(self, name):
+        if name == 'review':
+            return NO_REVIEWS
+        raise AttributeError("'{}' object has no attribute '{}'".format(type(self).__name__, name))
+
+    def add_review(self, review):
+        if self.review is NO_REVIEWS:
+            self.review = []
+        self.review.append(review)
+
+
+class Actor(Reviewable):
     def __init__(self, actor_full_name):
         self.actor_full_name = actor_full_name
-        self.review = []
         self.rating = 0
         self.rating_num = 0
 
@@ -34,10 +52,9 @@ class Actor:
         return colleague in self.colleague_list
 
 
-class Director:
+class Director(Reviewable):
     def __init__(self, director):
         self.director_full_name = director
-        self.review = []
         self.rating = 0
         self.rating_num = 0
 
@@ -60,10 +77,9 @@ class Director:
 
 
 
-class Genre:
+class Genre(Reviewable):
     def __init__(self, genre):
         self.genre_name = genre
-        self.review = []
         self.rating = 0
         self.rating_num = 0
 
@@ -85,7 +101,7 @@ class Genre:
         return hash(self.genre_name)
 
 
-class Movie:
+class Movie(Reviewable):
     def __init__(self, title, time):
         if time < 1900:
             raise ValueError("")
@@ -101,7 +117,6 @@ class Movie:
         self.meta = "N/A"
         self.revenue = "N/A"
         self.vote = 0
-        self.review = []
         self.add_comment_url = ''
 
     def __repr__(self):
@@ -168,6 +183,41 @@ class Review:
             return True
         return False
 
+    def subjects(self):
+        # The (kind, name) pairs this review is about: a movie title, or a director, genre or actor name.
+        names = (self.movie, self.directors, self.genres, self.actors)
+        return [(kind, name) for kind, name in zip(REVIEW_KINDS, names) if name is not None]
+
+
+# What a review can be about. ReviewAggregate.kind is one of these.
+REVIEW_KINDS = ('movie', 'director', 'genre', 'actor')
+
+
+class ReviewAggregate:
+    # Running totals of the reviews of one movie, director, genre or actor, keyed by its title or name.
+    # Reviews without a rating move last_reviewed but not the rating totals. review_count counts every
+    # review, so it also serves as a version of the pages showing the subject's reviews.
+    def __init__(self, kind, key):
+        self.kind = kind
+        self.key = key
+        self.rating_sum = 0
+        self.rating_count = 0
+        self.rating_mean = None
+        self.review_count = 0
+        self.last_reviewed = None
+
+    def __repr__(self):
+        return "<ReviewAggregate {} {}>".format(self.kind, self.key)
+
+    def add(self, review):
+        if review.rating is not None:
+            self.rating_sum += review.rating
+            self.rating_count += 1
+            self.rating_mean = self.rating_sum / self.rating_count
+        self.review_count += 1
+        if self.last_reviewed is None or review.time_stamp > self.last_reviewed:
+            self.last_reviewed = review.time_stamp
+
 
 class User:
     def __init__(self, user_name, password):
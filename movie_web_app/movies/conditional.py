@@ -0,0 +1,49 @@
+# conditional.py
+import hashlib
+import os
+import uuid
+
+from flask import current_app, make_response, request, session
+
+
+def etag_seed(build=None):
+    # Part of every page's ETag. It changes when the code or templates are redeployed, and with build, which
+    # names the data the pages are read from: the database build, or None for data only this process holds.
+    digest = hashlib.sha1()
+    package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for directory, subdirectories, files in os.walk(package):
+        subdirectories.sort()
+        for name in sorted(files):
+            if name.endswith(('.py', '.html')):
+                path = os.path.join(directory, name)
+                stat = os.stat(path)
+                digest.update('{} {} {}\n'.format(os.path.relpath(path, package), stat.st_size,
+                                                  stat.st_mtime_ns).encode())
+    digest.update((build or uuid.uuid4().hex).encode())
+    return digest.hexdigest()
+
+
+def page_etag(*parts):
+    # A strong ETag for a page that is fully determined by parts (e.g. the request arguments, the user and
+    # the versions of what it shows).
+    digest = hashlib.sha1(current_app.config['ETAG_SEED'].encode())
+    digest.update(repr(parts).encode())
+    return digest.hexdigest()
+
+
+def conditional_page(etag, render):
+    # An empty 304 if the client already holds the page tagged etag, otherwise the page render() returns.
+    # Clients and proxies may keep the page but must revalidate it before every use. Pages show who is
+    # logged in, so those of a logged in user are kept by their browser only.
+    if request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response(render())
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    if 'username' in session:
+        response.cache_control.private = True
+    else:
+        response.cache_control.public = True
+    response.vary.add('Cookie')
+    return response
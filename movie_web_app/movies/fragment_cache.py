@@ -0,0 +1,44 @@
+# fragment_cache.py
+import threading
+from collections import OrderedDict
+
+
+class FragmentCache:
+    # A bounded LRU cache of rendered page fragments, such as the card of a movie. Keys carry the version of
+    # what a fragment shows, so a changed fragment gets a new key instead of being invalidated; the outdated
+    # one is no longer read and is evicted in time.
+
+    def __init__(self, max_entries=2048):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._fragments = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._fragments)
+
+    def get(self, key):
+        with self._lock:
+            fragment = self._fragments.get(key)
+            if fragment is None:
+                self.misses += 1
+                return None
+            self._fragments.move_to_end(key)
+            self.hits += 1
+            return fragment
+
+    def put(self, key, fragment):
+        with self._lock:
+            self._fragments[key] = fragment
+            self._fragments.move_to_end(key)
+            while len(self._fragments) > self.max_entries:
+                self._fragments.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._fragments), 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
@@ -1,19 +1,27 @@
 # movies.py
 from typing import List
 
-from flask import Blueprint, render_template, url_for, redirect, request, session
-from movie_web_app.domain.model import Genre, Actor, Director
+from flask import Blueprint, render_template, url_for, redirect, request, session, current_app, stream_with_context
+from markupsafe import Markup
 
 import movie_web_app.adapters.repository as repo
+from movie_web_app.adapters.repository import MOVIE_LISTING
 from movie_web_app.adapters import database_repository
+from movie_web_app.movies.conditional import page_etag, conditional_page
 
 # Configure Blueprint.
 movies_blueprint = Blueprint('movies_bp', __name__)
 
+PER_PAGE = 6
+# Movies found per query while a streamed page is rendered.
+STREAM_BATCH_SIZE = 50
+STREAM_BUFFER_SIZE = 200
+
 
 @movies_blueprint.route('/display', methods=['GET'])
 def display_movies():
-    movie_list = []
+    movies = []
+    movie_count = 0
     movie_title = request.args.get('movie_title')
     name1 = request.args.get('name1')
     name2 = request.args.get('name2')
@@ -23,159 +31,227 @@ def display_movies():
     if title is None:
         title = 'Movies'
 
+    per_page = min(max(request.args.get('per_page', PER_PAGE, type=int), 1), current_app.config['MAX_PAGE_SIZE'])
+    cursor = request.args.get('cursor')
+    if cursor is None:
+        cursor = 0
+    else:
+        cursor = max(int(cursor), 0)
+    # Larger pages are sent while they are rendered, loading their movies a batch at a time, so neither the
+    # movies nor the page are ever held in full. They are neither cached nor tagged. A Review page shows one movie.
+    streamed = per_page > current_app.config['STREAM_PAGE_SIZE'] and title != 'Review'
+
+    # The page depends only on these, and on who is logged in (shown in the side bar).
+    page_key = (title, movie_title, name1, name2, name3, cursor, per_page, session.get('username'))
+    page_cache = current_app.extensions.get('page_cache')
+    if page_cache is not None and not streamed:
+        cached = page_cache.get(page_key)
+        if cached is not None:
+            movie_count, movie_ids, titles, versions, page = cached
+            # Reviews written by other processes sharing the database do not drop pages from this cache, so
+            # the page is tagged with its movies' current review versions, and only served while they are
+            # the versions it was rendered with.
+            current_versions = title_versions(titles)
+            if current_versions == versions:
+                etag = page_etag(page_key, movie_count, list(zip(movie_ids, current_versions)))
+                return conditional_page(etag, lambda: page)
+        generation = page_cache.generation
+
+    # The movies are found without their credits and reviews: movie_cards loads them for the cards it renders.
+    def find_movies(genres=(), actors=(), director=None):
+        if not streamed:
+            return repo.repo_instance.find_movies(genres=genres, actors=actors, director=director, offset=cursor,
+                                                  limit=per_page)
+        return repo.repo_instance.find_movie_ids(genres=genres, actors=actors, director=director, offset=cursor,
+                                                 limit=per_page)
+
     if title == 'Movies':
-        movie_list = repo.repo_instance.get_dataset_of_movies()
+        movies, movie_count = find_movies()
 
     if title == 'Genre':
-        try:
-            name1 = Genre(name1.strip().strip('<').strip('>'))
-        except:
-            pass
-        try:
-            name2 = Genre(name2.strip().strip('<').strip('>'))
-        except:
-            pass
-        try:
-            name3 = Genre(name3.strip().strip('<').strip('>'))
-        except:
-            pass
-
-        for movie in repo.repo_instance.get_dataset_of_movies():
-            if name1 is None and name2 is None and name3 is None:
-                return render_template('search_movie/lost.html',
-                                       title = 'genres',
-                                       redirect_url = url_for('search_bp.search_by_genre'))
-            if name1 in movie.genres and name2 in movie.genres and name3 in movie.genres:
-                movie_list.append(movie)
+        genre_names = strip_names(name1, name2, name3)
+        if len(genre_names) == 0:
+            return render_template('search_movie/lost.html',
+                                   title = 'genres',
+                                   redirect_url = url_for('search_bp.search_by_genre'))
+        movies, movie_count = find_movies(genres=genre_names)
 
     if title == 'Actor':
-        try:
-            name1 = Actor(name1.strip().strip('<').strip('>'))
-        except:
-            pass
-        try:
-            name2 = Actor(name2.strip().strip('<').strip('>'))
-        except:
-            pass
-        try:
-            name3 = Actor(name3.strip().strip('<').strip('>'))
-        except:
-            pass
-
-        for movie in repo.repo_instance.get_dataset_of_movies():
-            if name1 is None and name2 is None and name3 is None:
-                return render_template('search_movie/lost.html',
+        actor_names = strip_names(name1, name2, name3)
+        if len(actor_names) == 0:
+            return render_template('search_movie/lost.html',
                                    title='actors',
                                    redirect_url=url_for('search_bp.search_by_actor'))
-            if name1 in movie.actors and name2 in movie.actors and name3 in movie.actors:
-                movie_list.append(movie)
+        movies, movie_count = find_movies(actors=actor_names)
 
     if title == 'Review':
-        movie_list.append(repo.repo_instance.get_movie(movie_title))
+        movie = repo.repo_instance.get_movie(movie_title)
+        if movie is not None:
+            movies = [movie]
+            movie_count = 1
 
     if title == 'Director':
-        try:
-            name1 = Director(name1.strip().strip('<').strip('>'))
-        except:
-            pass
-        for movie in repo.repo_instance.get_dataset_of_movies():
-            if name1 in movie.director:
-                movie_list.append(movie)
-
-    per_page = 6
-    cursor = request.args.get('cursor')
-    if cursor is None:
-        cursor = 0
-    else:
-        cursor = int(cursor)
+        director_names = strip_names(name1)
+        if len(director_names) != 0:
+            movies, movie_count = find_movies(director=director_names[0])
+
+    if title == 'Search':
+        # name1 carries the search text, best matches first.
+        if name1 is None or name1.strip() == '':
+            return render_template('search_movie/lost.html',
+                                   title='text',
+                                   redirect_url=url_for('search_bp.search_by_text'))
+        movies, movie_count = repo.repo_instance.search_movies(name1, offset=cursor, limit=per_page)
+        if streamed:
+            movies = [movie.id for movie in movies]
 
-    movie_ids = []
-    for i in range(cursor, cursor + per_page):
-        movie_ids += [i]
-    movies = []
-    for id in movie_ids:
-        try:
-            movies += [movie_list[id]]
-        except:
-            pass
     first_movie_url = None
     last_movie_url = None
     prev_movie_url = None
     next_movie_url = None
+    # The paging links keep a page size other than the default.
+    link_args = dict(title=title, name1=name1, name2=name2, name3=name3,
+                     per_page=None if per_page == PER_PAGE else per_page)
     if cursor > 0:
-        prev_movie_url = url_for('movies_bp.display_movies', cursor = cursor - per_page, title = title, name1 = name1,name2 = name2,name3 = name3)
-        first_movie_url = url_for('movies_bp.display_movies', movie_list = movie_list, title = title,name1 = name1,name2 = name2,name3 = name3)
+        prev_movie_url = url_for('movies_bp.display_movies', cursor = max(cursor - per_page, 0), **link_args)
+        first_movie_url = url_for('movies_bp.display_movies', **link_args)
 
-    if cursor + per_page < len(movie_list):
-        next_movie_url = url_for('movies_bp.display_movies', cursor = cursor + per_page,title = title,name1 = name1,name2 = name2,name3 = name3)
+    if cursor + per_page < movie_count:
+        next_movie_url = url_for('movies_bp.display_movies', cursor = cursor + per_page, **link_args)
 
-        last_cursor = per_page * int(len(movie_list) / per_page)
-        if len(movie_list) % per_page == 0:
+        last_cursor = per_page * int(movie_count / per_page)
+        if movie_count % per_page == 0:
             last_cursor -= per_page
-        last_movie_url = url_for('movies_bp.display_movies', cursor=last_cursor,title = title,name1 = name1,name2 = name2,name3 = name3)
+        last_movie_url = url_for('movies_bp.display_movies', cursor=last_cursor, **link_args)
 
-    count = 0
-    for i in range(len(movie_list)):
-        try:
-            movie_list[i + cursor].add_comment_url = url_for('search_bp.comment_on_movie', title=movie_list[i +cursor].title)
-        except:
-            break
+    fragment_cache = current_app.extensions.get('fragment_cache')
+    context = dict(title= title,
+                   space1 = name1,
+                   space2 = name2,
+                   space3 = name3,
+                   first_movie_url=first_movie_url,
+                   last_movie_url=last_movie_url,
+                   prev_movie_url=prev_movie_url,
+                   next_movie_url=next_movie_url)
+    if streamed:
+        # movies holds the ids of the page's movies.
+        context['cards'] = lazy_cards(movies, fragment_cache)
+        return current_app.response_class(stream_with_context(stream_template('movies/display_movies.html', context)))
 
-        for d in movie_list[i +cursor].director:
-            d.add_comment_url = url_for('search_bp.comment_on_director', title = d.director_full_name)
+    # Besides the movies found, the page shows their reviews, so it is tagged with their versions.
+    versions = review_versions(movies)
+    movie_ids = [movie.id for movie in movies]
+    titles = [movie.title for movie in movies]
+    etag = page_etag(page_key, movie_count, list(zip(movie_ids, versions)))
 
+    def render():
+        page = render_template('movies/display_movies.html', cards=movie_cards(movies, versions, fragment_cache),
+                               **context)
+        if page_cache is not None:
+            page_cache.put(page_key, (movie_count, movie_ids, titles, versions, page), titles, generation)
+        return page
 
-        for g in movie_list[i +cursor].genres:
-            g.add_comment_url = url_for('search_bp.comment_on_genre', title = g.genre_name)
+    return conditional_page(etag, render)
 
-        for a in movie_list[i +cursor].actors:
-            a.add_comment_url = url_for('search_bp.comment_on_actor', title = a.actor_full_name)
 
+def review_versions(movies):
+    # A movie's version is the number of its reviews, as its aggregate counts them. It is read before the
+    # reviews are loaded, so a review added in between can only put newer content under an older version.
+    return title_versions([movie.title for movie in movies])
 
-        count += 1
-        if count == per_page:
-            break
-    return render_template('movies/display_movies.html',
-                           title= title,
-                           movies=movies,
-                           space1 = name1,
-                           space2 = name2,
-                           space3 = name3,
-                           first_movie_url=first_movie_url,
-                           last_movie_url=last_movie_url,
-                           prev_movie_url=prev_movie_url,
-                           next_movie_url=next_movie_url)
 
+def title_versions(titles):
+    aggregates = repo.repo_instance.get_review_aggregates('movie', set(titles))
+    return [aggregates[title].review_count if title in aggregates else 0 for title in titles]
+
+
+def movie_cards(movies, versions, fragment_cache=None):
+    # The rendered card of each movie: its details, reviews and comment button. Cards are cached by movie id
+    # and version, and only the movies whose cards are not cached are loaded with their credits and reviews.
+    keys = [(movie.id, version) for movie, version in zip(movies, versions)]
+    cards = [fragment_cache.get(key) if fragment_cache is not None else None for key in keys]
+    missing = [movie.id for movie, card in zip(movies, cards) if card is None]
+    if missing:
+        template = current_app.jinja_env.get_template('movies/movie_card.html')
+        loaded = {movie.id: movie for movie in repo.repo_instance.get_movies_by_ids(missing, MOVIE_LISTING)}
+        for i, key in enumerate(keys):
+            if cards[i] is None:
+                # A card needs nothing from the request's template context but url_for, a global.
+                cards[i] = Markup(template.render(movie=loaded[key[0]]))
+                if fragment_cache is not None:
+                    fragment_cache.put(key, cards[i])
+    return cards
+
+
+def lazy_cards(movie_ids, fragment_cache=None):
+    # The cards of the movies with the ids, found and rendered STREAM_BATCH_SIZE at a time, as the page
+    # reaches them.
+    for start in range(0, len(movie_ids), STREAM_BATCH_SIZE):
+        movies = repo.repo_instance.get_movies_by_ids(movie_ids[start:start + STREAM_BATCH_SIZE])
+        yield from movie_cards(movies, review_versions(movies), fragment_cache)
+
+
+def stream_template(template_name, context):
+    # render_template, but yielding the page in pieces as it is rendered. Each piece gathers
+    # STREAM_BUFFER_SIZE of the template's small output fragments.
+    current_app.update_template_context(context)
+    stream = current_app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(STREAM_BUFFER_SIZE)
+    return stream
+
+
+def strip_names(*names):
+    # Search names arrive as '<name>' (the repr of the entity) or None when a field was left unmatched.
+    return [name.strip().strip('<').strip('>') for name in names if name is not None]
 
 
 @movies_blueprint.route('/display_actor', methods=['GET'])
 def display_actor():
     name = request.args.get('name')
-    actor = repo.repo_instance.get_actor(name)
-    if isinstance(actor, list):
-        actor = actor[0]
-    actor.add_comment_url = url_for('search_bp.comment_on_actor', title=actor.actor_full_name)
-    return render_template('movies/display_other.html',
-                           name = actor)
+    # The page shows the actor's reviews: their count is its version. The aggregate is read before the
+    # reviews, so a review added in between can only leave an older tag on a newer page, never the reverse.
+    aggregate = repo.repo_instance.get_review_aggregate('actor', name)
+    etag = page_etag('actor', name, session.get('username'), aggregate.review_count if aggregate else 0)
+
+    def render():
+        actor = repo.repo_instance.get_actor(name)
+        actor.add_comment_url = url_for('search_bp.comment_on_actor', title=actor.actor_full_name)
+        return render_template('movies/display_other.html',
+                               name = actor,
+                               aggregate = aggregate)
+
+    return conditional_page(etag, render)
 
 
 @movies_blueprint.route('/display_genre', methods=['GET'])
 def display_genre():
     name = request.args.get('name')
-    genre = repo.repo_instance.get_genre(name)
-    if isinstance(genre, list):
-        genre = genre[0]
-    genre.add_comment_url = url_for('search_bp.comment_on_genre', title=genre.genre_name)
-    return render_template('movies/display_other.html',
-                           name = genre)
+    # Tagged as in display_actor.
+    aggregate = repo.repo_instance.get_review_aggregate('genre', name)
+    etag = page_etag('genre', name, session.get('username'), aggregate.review_count if aggregate else 0)
+
+    def render():
+        genre = repo.repo_instance.get_genre(name)
+        genre.add_comment_url = url_for('search_bp.comment_on_genre', title=genre.genre_name)
+        return render_template('movies/display_other.html',
+                               name = genre,
+                               aggregate = aggregate)
+
+    return conditional_page(etag, render)
 
 
 @movies_blueprint.route('/display_director', methods=['GET'])
 def display_director():
     name = request.args.get('name')
-    director = repo.repo_instance.get_director(name)
-    if isinstance(director, list):
-        director = director[0]
-    director.add_comment_url = url_for('search_bp.comment_on_director', title = director.director_full_name)
-    return render_template('movies/display_other.html',
-                           name = director)
+    # Tagged as in display_actor.
+    aggregate = repo.repo_instance.get_review_aggregate('director', name)
+    etag = page_etag('director', name, session.get('username'), aggregate.review_count if aggregate else 0)
+
+    def render():
+        director = repo.repo_instance.get_director(name)
+        director.add_comment_url = url_for('search_bp.comment_on_director', title=director.director_full_name)
+        return render_template('movies/display_other.html',
+                               name = director,
+                               aggregate = aggregate)
+
+    return conditional_page(etag, render)
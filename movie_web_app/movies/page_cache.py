@@ -0,0 +1,81 @@
+# page_cache.py
+import threading
+from collections import OrderedDict
+
+
+class PageCache:
+    # A bounded LRU cache of rendered movie listing pages. Each page is stored with the titles of the movies
+    # it shows, so a new review of a movie drops exactly the pages that show that movie.
+    # generation counts invalidations. A page rendered from data read before an invalidation may be missing
+    # the review that caused it, so put() only stores pages rendered since the latest invalidation.
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.generation = 0
+        # key -> (page, titles of the movies on the page), least recently used first
+        self._pages = OrderedDict()
+        # movie title -> keys of the pages showing it
+        self._keys_by_title = dict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pages)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._pages.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._pages.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, page, titles, generation):
+        # Stores a page rendered by a request that started when the cache was at generation.
+        with self._lock:
+            if generation != self.generation:
+                return
+            if key in self._pages:
+                self._remove(key)
+            self._pages[key] = (page, frozenset(titles))
+            for title in titles:
+                self._keys_by_title.setdefault(title, set()).add(key)
+            while len(self._pages) > self.max_entries:
+                self._remove(next(iter(self._pages)))
+                self.evictions += 1
+
+    def invalidate_titles(self, titles):
+        # Drops every page showing a movie with one of the titles.
+        with self._lock:
+            self.generation += 1
+            for title in titles:
+                for key in self._keys_by_title.pop(title, ()):
+                    if key in self._pages:
+                        self._remove(key)
+                        self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._pages.clear()
+            self._keys_by_title.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._pages), 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'invalidations': self.invalidations}
+
+    def _remove(self, key):
+        _, titles = self._pages.pop(key)
+        for title in titles:
+            keys = self._keys_by_title.get(title)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_title[title]
@@ -1,13 +1,12 @@
 # search_movie.py
-from flask import Blueprint, render_template, url_for, redirect, request, session
+from flask import Blueprint, render_template, url_for, redirect, request, session, jsonify, abort
 from flask_wtf import FlaskForm
 from wtforms import SubmitField, StringField, TextAreaField, HiddenField, IntegerField
 from wtforms.validators import DataRequired, Length, ValidationError
 import movie_web_app.adapters.repository as repo
+from movie_web_app.adapters.repository import NAME_KINDS
 from movie_web_app.authentication.authentication import login_required
 from movie_web_app.domain.model import Review
-from sqlalchemy.orm.collections import InstrumentedList
-import sqlalchemy
 
 # Configure Blueprint.
 search_blueprint = Blueprint('search_bp', __name__)
@@ -26,6 +25,7 @@ def search_by_director():
         return redirect(url_for('movies_bp.display_movies', title='Director', name1= director))
     return render_template('search_movie/director.html',
                            form = form,
+                           kind = 'director',
                            handler_url = url_for('search_bp.search_by_director'))
 
 
@@ -47,6 +47,7 @@ def search_by_genre():
         return redirect(url_for('movies_bp.display_movies', title='Genre', name1=genre1,name2 = genre2, name3 = genre3))
     return render_template('search_movie/genre_actor.html',
                            form = form,
+                           kind = 'genre',
                            handler_url = url_for('search_bp.search_by_genre'))
 
 
@@ -70,6 +71,7 @@ def search_by_actor():
         return redirect(url_for('movies_bp.display_movies', title='Actor', name1=actor1, name2=actor2, name3=actor3))
     return render_template('search_movie/genre_actor.html',
                            form = form,
+                           kind = 'actor',
                            handler_url = url_for('search_bp.search_by_actor'))
 
 
@@ -80,6 +82,34 @@ class ActorForm(FlaskForm):
     submit = SubmitField('Search by Actor')
 
 
+@search_blueprint.route('/typeahead', methods=['GET'])
+def typeahead():
+    # Suggestions for the search forms: up to limit (at most 50) actor, director or genre names starting
+    # with prefix, ignoring case.
+    kind = request.args.get('kind')
+    if kind not in NAME_KINDS:
+        abort(400)
+    prefix = request.args.get('prefix', '')
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 50)
+    return jsonify(kind=kind, prefix=prefix,
+                   names=repo.repo_instance.get_names_starting_with(kind, prefix, limit))
+
+
+@search_blueprint.route('/search_by_text', methods=['GET', 'POST'])
+def search_by_text():
+    form = TextForm()
+    if form.validate_on_submit():
+        return redirect(url_for('movies_bp.display_movies', title='Search', name1=form.text.data))
+    return render_template('search_movie/text.html',
+                           form = form,
+                           handler_url = url_for('search_bp.search_by_text'))
+
+
+class TextForm(FlaskForm):
+    text = StringField('Words or "phrases"',[DataRequired(message='Search text is required')])
+    submit = SubmitField('Search titles, descriptions and reviews')
+
+
 @search_blueprint.route('/comment', methods=['GET', 'POST'])
 @login_required
 def comment_on_movie():
@@ -88,11 +118,9 @@ def comment_on_movie():
     if form.validate_on_submit():
         title = form.title.data
         review = Review(username, title, None,None,None,form.comment.data, form.rating.data)
+        # The repository adds the review to the movie and updates its rating totals.
+        repo.repo_instance.add_review(review)
         movie = repo.repo_instance.get_movie(title)
-        if isinstance(movie.review, sqlalchemy.orm.collections.InstrumentedList):
-            repo.repo_instance.add_review(review)
-        else:
-            movie.review.append(review)
         movie.add_comment_url = url_for('search_bp.comment_on_movie', title=movie.title)
         return redirect(url_for('movies_bp.display_movies', title = 'Review', movie_title= title))
 
@@ -106,6 +134,7 @@ def comment_on_movie():
         'search_movie/comment_on_movie.html',
         title='Review',
         movie=movie,
+        aggregate=repo.repo_instance.get_review_aggregate('movie', title),
         comment = movie.review,
         form=form,
         handler_url=url_for('search_bp.comment_on_movie'))
@@ -119,18 +148,9 @@ def comment_on_actor():
     if form.validate_on_submit():
         title = form.title.data
         review = Review(username, None,None,None, title,form.comment.data, form.rating.data)
+        # The repository adds the review to the actor and updates its rating totals.
+        repo.repo_instance.add_review(review)
         actor = repo.repo_instance.get_actor(title)
-        if isinstance(actor,list):
-            actor= actor[0]
-        if isinstance(actor.review, sqlalchemy.orm.collections.InstrumentedList):
-            repo.repo_instance.add_review(review)
-        else:
-            actor.review.append(review)
-        try:
-            actor.rating += review.rating
-            actor.rating_num += 1
-        except:
-            pass
         actor.add_comment_url = url_for('search_bp.comment_on_actor', title=actor.actor_full_name)
         return redirect(url_for('movies_bp.display_actor', title = 'Review_Actor', name= title))
 
@@ -140,12 +160,11 @@ def comment_on_actor():
     else:
         title = form.title.data
     actor = repo.repo_instance.get_actor(title)
-    if isinstance(actor, list):
-        actor = actor[0]
     return render_template(
         'search_movie/comment_on_other.html',
         title='Review_Actor',
         name=actor,
+        aggregate=repo.repo_instance.get_review_aggregate('actor', title),
         comment = actor.review,
         form=form,
         handler_url=url_for('search_bp.comment_on_actor'))
@@ -159,18 +178,9 @@ def comment_on_genre():
     if form.validate_on_submit():
         title = form.title.data
         review = Review(username, None,None,title,None, form.comment.data, form.rating.data)
+        # The repository adds the review to the genre and updates its rating totals.
+        repo.repo_instance.add_review(review)
         genre = repo.repo_instance.get_genre(title)
-        if isinstance(genre,list):
-            genre = genre[0]
-        if isinstance(genre.review, sqlalchemy.orm.collections.InstrumentedList):
-            repo.repo_instance.add_review(review)
-        else:
-            genre.review.append(review)
-        try:
-            genre.rating += review.rating
-            genre.rating_num += 1
-        except:
-            pass
         genre.add_comment_url = url_for('search_bp.comment_on_genre', title=genre.genre_name)
         return redirect(url_for('movies_bp.display_genre', title = 'Review_Genre', name= title))
 
@@ -180,12 +190,11 @@ def comment_on_genre():
     else:
         title = form.title.data
     genre = repo.repo_instance.get_genre(title)
-    if isinstance(genre, list):
-        genre = genre[0]
     return render_template(
         'search_movie/comment_on_other.html',
         title='Review_Genre',
         name=genre,
+        aggregate=repo.repo_instance.get_review_aggregate('genre', title),
         comment = genre.review,
         form=form,
         handler_url=url_for('search_bp.comment_on_genre'))
@@ -199,18 +208,9 @@ def comment_on_director():
     if form.validate_on_submit():
         title = form.title.data
         review = Review(username, None, title, None, None, form.comment.data, form.rating.data)
+        # The repository adds the review to the director and updates its rating totals.
+        repo.repo_instance.add_review(review)
         director = repo.repo_instance.get_director(title)
-        if isinstance(director,list):
-            director = director[0]
-        if isinstance(director.review, sqlalchemy.orm.collections.InstrumentedList):
-            repo.repo_instance.add_review(review)
-        else:
-            director.review.append(review)
-        try:
-            director.rating += review.rating
-            director.rating_num += 1
-        except:
-            pass
         director.add_comment_url = url_for('search_bp.comment_on_director', title=director.director_full_name)
         return redirect(url_for('movies_bp.display_director', title = 'Review_Director', name= title))
 
@@ -220,12 +220,11 @@ def comment_on_director():
     else:
         title = form.title.data
     director = repo.repo_instance.get_director(title)
-    if isinstance(director,list):
-        director = director[0]
     return render_template(
         'search_movie/comment_on_other.html',
         title='Review_Director',
         name=director,
+        aggregate=repo.repo_instance.get_review_aggregate('director', title),
         comment = director.review,
         form=form,
         handler_url=url_for('search_bp.comment_on_director'))
@@ -84,6 +84,7 @@ def client():
     my_app = create_app({
         'TESTING': True,  # Set to True during testing.
         'REPOSITORY': 'database',
+        'REBUILD_DATABASE': True,  # Start every test from a freshly populated database.
         'TEST_DATA_PATH': TEST_DATA_PATH_DATABASE,  # Path for loading test data into the repository.
         'WTF_CSRF_ENABLED': False  # test_client will not send a CSRF token, so disable validation.
     })
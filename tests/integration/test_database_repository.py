@@ -1,10 +1,24 @@
+import os
+import shutil
+import time
 from datetime import date, datetime
 
 import pytest
 
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import sessionmaker
+
+from movie_web_app.adapters import database_repository, orm
 from movie_web_app.adapters.database_repository import SqlAlchemyRepository
+from movie_web_app.adapters.memory_repository import MemoryRepository, read_csv_file
+from movie_web_app.adapters.repository import MOVIE_LISTING
+from movie_web_app.adapters.write_behind import ReviewWriteBehind
+from movie_web_app.adapters.orm import metadata
 from movie_web_app.domain.model import User, Movie, Director, Actor, Review, Genre
 
+from tests.conftest import TEST_DATA_PATH_DATABASE
+
 def test_repository_can_add_a_user(session_factory):
     repo = SqlAlchemyRepository(session_factory)
 
@@ -71,7 +85,7 @@ def test_repository_can_add_a_director(session_factory):
     repo = SqlAlchemyRepository(session_factory)
     director = Director('Aoba')
     repo.add_director(director)
-    director1 = repo.get_director('Aoba')[0]
+    director1 = repo.get_director('Aoba')
     assert director1 == director and director1 is director
 
 
@@ -79,14 +93,14 @@ def test_repository_does_not_retrieve_a_non_existent_director(session_factory):
     repo = SqlAlchemyRepository(session_factory)
 
     director = repo.get_director('?')
-    assert director == []
+    assert director is None
 
 
 def test_repository_can_add_a_actor(session_factory):
     repo = SqlAlchemyRepository(session_factory)
     actor = Actor('Aoba')
     repo.add_actor(actor)
-    actor1 = repo.get_actor('Aoba')[0]
+    actor1 = repo.get_actor('Aoba')
     assert actor1 == actor and actor1 is actor
 
 
@@ -94,14 +108,14 @@ def test_repository_does_not_retrieve_a_non_existent_actor(session_factory):
     repo = SqlAlchemyRepository(session_factory)
 
     actor = repo.get_actor('?')
-    assert actor == []
+    assert actor is None
 
 
 def test_repository_can_add_a_genre(session_factory):
     repo = SqlAlchemyRepository(session_factory)
     genre = Genre('Aoba')
     repo.add_genre(genre)
-    genre1 = repo.get_genre('Aoba')[0]
+    genre1 = repo.get_genre('Aoba')
     assert genre1 == genre and genre1 is genre
 
 
@@ -109,7 +123,7 @@ def test_repository_does_not_retrieve_a_non_existent_genre(session_factory):
     repo = SqlAlchemyRepository(session_factory)
 
     genre = repo.get_genre('?')
-    assert genre == []
+    assert genre is None
 
 
 def test_repository_can_add_a_review(session_factory):
@@ -120,3 +134,511 @@ def test_repository_can_add_a_review(session_factory):
     repo.add_review(review)
     review1 = repo.get_review()[0]
     assert review == review1 and review1 is review
+
+
+def test_repository_can_retrieve_movie_ids_by_genres(session_factory):
+    repo = SqlAlchemyRepository(session_factory)
+
+    assert repo.find_movie_ids(genres=['Action', 'Adventure']) == ([5, 6], 2)
+    assert repo.find_movie_ids(genres=['Comedy']) == ([4, 7, 8], 3)
+
+
+def test_repository_can_retrieve_movie_ids_by_actors_and_director(session_factory):
+    repo = SqlAlchemyRepository(session_factory)
+
+    assert repo.find_movie_ids(actors=['Noomi Rapace', 'Logan Marshall-Green']) == ([2], 1)
+    assert repo.find_movie_ids(director='Ridley Scott') == ([2], 1)
+    assert repo.find_movie_ids(actors=['Noomi Rapace'], genres=['Comedy']) == ([], 0)
+
+
+def test_repository_can_retrieve_movies_by_ids(session_factory):
+    repo = SqlAlchemyRepository(session_factory)
+
+    movies = repo.get_movies_by_ids([7, 2, 100])
+    assert [movie.title for movie in movies] == ['La La Land', 'Prometheus']
+
+
+def test_repository_can_retrieve_a_page_of_movies(session_factory):
+    repo = SqlAlchemyRepository(session_factory)
+
+    movies, movie_count = repo.find_movies(offset=2, limit=3)
+    assert movie_count == 7
+    assert [movie.id for movie in movies] == [4, 5, 6]
+
+
+def test_repository_can_retrieve_a_filtered_page_of_movies(session_factory):
+    repo = SqlAlchemyRepository(session_factory)
+
+    movies, movie_count = repo.find_movies(genres=['Comedy'], offset=1, limit=6)
+    assert movie_count == 3
+    assert [movie.title for movie in movies] == ['La La Land', 'Mindhorn']
+
+
+
+def test_repository_finds_only_the_ids_of_a_page_of_movies(session_factory):
+    repo = SqlAlchemyRepository(session_factory)
+
+    assert repo.find_movie_ids(offset=2, limit=3) == ([4, 5, 6], 7)
+    assert repo.find_movie_ids(genres=['Comedy'], offset=1, limit=1) == ([7], 3)
+    assert repo.find_movie_ids(genres=['Comedy'], offset=10) == ([], 3)
+    assert list(repo.iter_movie_ids(offset=5)) == [7, 8]
+    assert list(repo.iter_movie_ids(genres=['Comedy'], director='Damien Chazelle')) == [7]
+
+
+def test_repository_finds_movies_with_all_of_the_given_names(session_factory):
+    repo = SqlAlchemyRepository(session_factory)
+
+    movies, movie_count = repo.find_movies(genres=['Action', 'Adventure'], actors=['Matt Damon', 'Matt Damon'])
+    assert movie_count == 1
+    assert [movie.title for movie in movies] == ['The Great Wall']
+
+    movies, movie_count = repo.find_movies(genres=['Comedy'], director='Damien Chazelle')
+    assert movie_count == 1
+    assert [movie.title for movie in movies] == ['La La Land']
+
+    assert repo.find_movies(genres=['Action', 'Western']) == ([], 0)
+    assert repo.find_movies(genres=['Comedy'], offset=10, limit=6) == ([], 3)
+
+
+def test_repository_loading_plan_fetches_relationships_up_front(session_factory):
+    repo = SqlAlchemyRepository(session_factory)
+
+    movies, movie_count = repo.find_movies(limit=6)
+    assert all({'director', 'genres', 'actors', 'review'} <= inspect(movie).unloaded for movie in movies)
+
+    repo.reset_session()
+    movies, movie_count = repo.find_movies(limit=6, load=MOVIE_LISTING)
+    assert all(inspect(movie).unloaded == set() for movie in movies)
+
+    with pytest.raises(ValueError):
+        repo.get_movies_by_ids([2], load=('sequels',))
+
+
+def test_repository_can_filter_movie_ids_by_value_ranges(session_factory):
+    repo = SqlAlchemyRepository(session_factory)
+
+    assert repo.get_movie_ids_by_values({'time': (2016, 2016), 'rating': (7.2, None)}) == [3, 4, 7]
+    assert repo.get_movie_ids_by_values(order_by='revenue', descending=True) == [5, 4, 7, 3, 2, 6, 8]
+
+
+def test_repository_has_one_row_per_actor(session_factory):
+    repo = SqlAlchemyRepository(session_factory)
+
+    actor = repo.get_actor('Noomi Rapace')
+    assert actor.actor_full_name == 'Noomi Rapace'
+    assert [movie.title for movie in actor.movies] == ['Prometheus']
+
+
+def test_repository_keeps_the_order_of_a_movies_credits(session_factory):
+    repo = SqlAlchemyRepository(session_factory)
+
+    movie = repo.get_movie('Prometheus')
+    assert [actor.actor_full_name for actor in movie.actors] == [
+        'Noomi Rapace', 'Logan Marshall-Green', 'Michael Fassbender', 'Charlize Theron']
+    assert [genre.genre_name for genre in movie.genres] == ['Adventure', 'Mystery', 'Sci-Fi']
+    assert movie.director == [Director('Ridley Scott')]
+
+
+def test_repository_add_movie_reuses_existing_genres(session_factory):
+    repo = SqlAlchemyRepository(session_factory)
+    repo.add_movie(1, 'Guardians of the Galaxy', 2014, '', 'James Gunn',
+                   'Chris Pratt, Vin Diesel', 'Action,Sci-Fi', 121, 8.1, 333.13, 76, 757074)
+
+    assert repo.find_movie_ids(genres=['Action']) == ([1, 5, 6], 3)
+    assert repo.get_genre('Action') is repo.get_movie('Guardians of the Galaxy').genres[0]
+
+
+def test_legacy_schema_is_migrated_to_one_row_per_name():
+    engine = create_engine('sqlite://')
+    metadata.create_all(engine, tables=[orm.users, orm.movies, orm.reviews])
+    for table, name in (('directors', 'director_full_name'), ('actors', 'actor_full_name'), ('genres', 'genre_name')):
+        engine.execute("""CREATE TABLE {} (id INTEGER PRIMARY KEY, movie VARCHAR(255), {} VARCHAR(255) NOT NULL,
+                          rating INTEGER, rating_num INTEGER, add_url VARCHAR(255))""".format(table, name))
+    engine.execute("""INSERT INTO movies (id, title, description, time, runtime, rating, votes, revenue, metascore)
+                      VALUES (5, 'Suicide Squad', '', 2016, 123, 6.2, 393727, 325.02, 40),
+                             (6, 'The Great Wall', '', 2016, 103, 6.1, 56036, 45.13, 42)""")
+    engine.execute("""INSERT INTO actors (movie, actor_full_name, rating, rating_num)
+                      VALUES ('Suicide Squad', 'Will Smith', 8, 1), ('Suicide Squad', 'Jared Leto', 0, 0),
+                             ('The Great Wall', 'Matt Damon', 0, 0), ('The Great Wall', 'Will Smith', 6, 1)""")
+    engine.execute("INSERT INTO genres (movie, genre_name, rating, rating_num) VALUES ('Suicide Squad', 'Action', 0, 0), ('The Great Wall', 'Action', 0, 0)")
+    engine.execute("INSERT INTO directors (movie, director_full_name, rating, rating_num) VALUES ('Suicide Squad', 'David Ayer', 0, 0)")
+
+    assert database_repository.migrate_legacy_schema(engine)
+    assert not database_repository.migrate_legacy_schema(engine)
+
+    assert list(engine.execute("SELECT actor_full_name, rating, rating_num FROM actors ORDER BY id")) == [
+        ('Will Smith', 14, 2), ('Jared Leto', 0, 0), ('Matt Damon', 0, 0)]
+    assert list(engine.execute("SELECT movie_id, actor_id FROM movie_actors ORDER BY id")) == [(5, 1), (5, 2), (6, 3), (6, 1)]
+    assert list(engine.execute("SELECT movie_id, genre_id FROM movie_genres ORDER BY id")) == [(5, 1), (6, 1)]
+    assert list(engine.execute("SELECT movie_id, director_id FROM movie_directors")) == [(5, 1)]
+
+
+def test_database_is_current_only_after_a_recorded_build(tmp_path):
+    data_path = str(tmp_path / 'movies.csv')
+    shutil.copyfile(TEST_DATA_PATH_DATABASE, data_path)
+    engine = create_engine('sqlite://')
+
+    assert not database_repository.database_is_current(engine, data_path)
+
+    metadata.create_all(engine)
+    database_repository.populate(engine, data_path)
+    assert not database_repository.database_is_current(engine, data_path)
+
+    database_repository.record_database_build(engine, data_path)
+    assert database_repository.database_is_current(engine, data_path)
+
+    # Touched but unchanged: the content hash still matches.
+    os.utime(data_path, ns=(0, 0))
+    assert database_repository.database_is_current(engine, data_path)
+
+    with open(data_path, 'a') as outfile:
+        outfile.write('9,Extra,Drama,,Someone,Someone Else,2017,100,7.0,100,1.0,50\n')
+    assert not database_repository.database_is_current(engine, data_path)
+
+
+def test_rebuilding_the_catalog_keeps_users_and_reviews(tmp_path):
+    data_path = str(tmp_path / 'movies.csv')
+    shutil.copyfile(TEST_DATA_PATH_DATABASE, data_path)
+    engine = create_engine('sqlite://')
+    metadata.create_all(engine)
+    database_repository.rebuild_catalog(engine, data_path)
+    engine.execute(orm.users.insert().values(user_name='kurisu', password='1234Qwer'))
+    engine.execute(orm.reviews.insert().values(user='kurisu', movie='Sing', review='Catchy', rating=8))
+
+    with open(data_path, 'a') as outfile:
+        outfile.write('\n9,Extra,Drama,,Someone,Someone Else,2017,100,7.0,100,1.0,50\n')
+    database_repository.rebuild_catalog(engine, data_path)
+
+    assert database_repository.database_is_current(engine, data_path)
+    assert engine.execute('SELECT count(*) FROM movies').scalar() == 8
+    assert list(engine.execute('SELECT user_name FROM users')) == [('kurisu',)]
+    assert list(engine.execute('SELECT movie, review FROM reviews')) == [('Sing', 'Catchy')]
+    assert list(engine.execute("SELECT key, review_count FROM review_aggregates WHERE kind = 'movie'")) == [('Sing', 1)]
+    assert list(engine.execute("SELECT rowid FROM movie_search WHERE movie_search MATCH 'catchy'")) == [(4,)]
+
+
+def test_schema_is_migrated_in_place(tmp_path):
+    engine = create_engine('sqlite://')
+    metadata.create_all(engine)
+    database_repository.rebuild_catalog(engine, TEST_DATA_PATH_DATABASE)
+    engine.execute(orm.users.insert().values(user_name='kurisu', password='1234Qwer'))
+    engine.execute(orm.reviews.insert().values(user='kurisu', movie='Sing', review='Catchy', rating=8))
+    # As built before the search index, the name indexes and review_count.
+    engine.execute('DROP TABLE movie_search')
+    engine.execute('DROP INDEX ix_genres_genre_name_nocase')
+    engine.execute('ALTER TABLE review_aggregates DROP COLUMN review_count')
+
+    assert database_repository.migrate_schema(engine) == {'movie_search', 'review_aggregates'}
+    assert database_repository.migrate_schema(engine) == set()
+    assert database_repository.database_is_current(engine, TEST_DATA_PATH_DATABASE)
+    assert list(engine.execute('SELECT user_name FROM users')) == [('kurisu',)]
+    assert list(engine.execute("SELECT key, review_count FROM review_aggregates WHERE kind = 'movie'")) == [('Sing', 1)]
+    assert list(engine.execute("SELECT rowid FROM movie_search WHERE movie_search MATCH 'catchy'")) == [(4,)]
+    assert 'ix_genres_genre_name_nocase' in [index['name'] for index in inspect(engine).get_indexes('genres')]
+
+
+
+def test_reset_session_keeps_the_registry_and_replaces_the_session(session_factory):
+    repo = SqlAlchemyRepository(session_factory)
+    registry = repo._session_cm.session
+    first = registry()
+
+    repo.reset_session()
+
+    assert repo._session_cm.session is registry
+    assert registry() is not first
+    assert repo.get_movie('Split').id == 3
+
+
+def test_database_engine_pools_connections(tmp_path):
+    engine = database_repository.create_database_engine('sqlite:///' + str(tmp_path / 'pooled.db'), pool_size=2)
+    for _ in range(3):
+        with engine.connect() as connection:
+            connection.execute('SELECT 1')
+    assert engine.pool.checkedin() == 1
+
+    in_memory = database_repository.create_database_engine('sqlite://')
+    in_memory.execute('CREATE TABLE t (x INTEGER)')
+    assert in_memory.execute('SELECT COUNT(*) FROM t').scalar() == 0
+
+    with pytest.raises(ValueError):
+        database_repository.create_database_engine('sqlite://', pool='bogus')
+
+
+def test_tuned_profile_is_applied_to_every_connection(tmp_path):
+    engine = database_repository.create_database_engine('sqlite:///' + str(tmp_path / 'tuned.db'))
+    with engine.connect() as first, engine.connect() as second:
+        for connection in (first, second):
+            assert connection.execute('PRAGMA journal_mode').scalar() == 'wal'
+            assert connection.execute('PRAGMA cache_size').scalar() == -64 * 1024
+            assert connection.execute('PRAGMA temp_store').scalar() == 2
+
+    untuned = database_repository.create_database_engine('sqlite:///' + str(tmp_path / 'untuned.db'), profile='default')
+    assert untuned.execute('PRAGMA journal_mode').scalar() == 'delete'
+
+
+def test_readers_do_not_block_review_writes_in_wal_mode(tmp_path):
+    engine = database_repository.create_database_engine('sqlite:///' + str(tmp_path / 'wal.db'))
+    metadata.create_all(engine)
+    database_repository.populate(engine, TEST_DATA_PATH_DATABASE)
+
+    # pysqlite only starts transactions for writes, so open the read transaction by hand.
+    reader = engine.raw_connection()
+    reader.isolation_level = None
+    cursor = reader.cursor()
+    cursor.execute('BEGIN')
+    assert cursor.execute('SELECT COUNT(*) FROM reviews').fetchone() == (0,)
+
+    engine.execute(orm.reviews.insert(), {'user': 'kurisu', 'movie': 'Split', 'review': 'Great', 'rating': 8})
+
+    # The open read transaction keeps its snapshot; new readers see the review.
+    assert cursor.execute('SELECT COUNT(*) FROM reviews').fetchone() == (0,)
+    cursor.execute('COMMIT')
+    reader.close()
+    assert engine.execute('SELECT COUNT(*) FROM reviews').scalar() == 1
+
+
+def test_populate_gathers_planner_statistics(session_factory):
+    session = session_factory()
+    tables = {row[0] for row in session.execute('SELECT tbl FROM sqlite_stat1')}
+    assert {'movies', 'actors', 'movie_actors'} <= tables
+
+
+def test_populate_restores_the_connection_settings_when_the_load_fails(tmp_path):
+    engine = database_repository.create_database_engine('sqlite:///' + str(tmp_path / 'movies.db'), pool_size=1,
+                                                        max_overflow=0)
+    metadata.create_all(engine)
+    synchronous = engine.execute('PRAGMA synchronous').scalar()
+
+    with pytest.raises(FileNotFoundError):
+        database_repository.populate(engine, str(tmp_path / 'missing'))
+    # The pool's only connection is the one the load used.
+    assert engine.execute('PRAGMA synchronous').scalar() == synchronous != 0
+
+
+def test_reads_go_to_a_read_only_engine_and_writes_to_the_writer(database_engine):
+    database_uri = str(database_engine.url)
+    writer = database_repository.create_database_engine(database_uri, pool_size=1, max_overflow=0)
+    reader = database_repository.create_database_engine(database_uri, read_only=True)
+    repo = SqlAlchemyRepository(sessionmaker(bind=writer), sessionmaker(bind=reader, autoflush=False))
+
+    with pytest.raises(OperationalError):
+        reader.execute(orm.users.insert(), {'user_name': 'dave', 'password': '123456789'})
+
+    movie = repo.get_movie('Split')
+    assert len(movie.review) == 0
+    repo.add_review(Review('kurisu', 'Split', None, None, None, 'Unsettling', 8))
+    assert [review.review_text for review in movie.review] == ['Unsettling']
+
+    # A writer holding the write lock does not stop the readers.
+    with writer.connect() as connection:
+        transaction = connection.begin()
+        connection.execute(orm.users.insert(), {'user_name': 'dave', 'password': '123456789'})
+        repo.reset_session()
+        assert repo.get_movie('Split').title == 'Split'
+        assert repo.get_user('dave') is None
+        transaction.commit()
+    assert repo.get_user('dave') is not None
+
+    writer.dispose()
+    reader.dispose()
+
+
+def test_write_behind_writes_reviews_in_batches(database_engine):
+    commits = []
+    event.listen(database_engine, 'commit', lambda connection: commits.append(connection))
+    writer = ReviewWriteBehind(sessionmaker(bind=database_engine), batch_size=3, max_delay=60)
+    repo = SqlAlchemyRepository(sessionmaker(bind=database_engine), review_writer=writer)
+    try:
+        repo.add_review(Review('kurisu', 'Split', None, None, None, 'Unsettling', 8))
+        repo.add_review(Review('okabe', 'Split', None, None, None, 'Tense', 7))
+        assert len(writer) == 2
+        assert repo.get_review() == []
+
+        # The third review fills the batch, and all three are written in one transaction.
+        repo.add_review(Review('kurisu', 'Sing', None, None, None, 'Catchy', 6))
+        assert len(writer) == 0
+        assert len(commits) == 1
+        repo.reset_session()
+        assert [review.review_text for review in repo.get_review()] == ['Unsettling', 'Tense', 'Catchy']
+    finally:
+        writer.close()
+
+
+def test_write_behind_flushes_a_users_reviews_and_everything_on_close(database_engine):
+    writer = ReviewWriteBehind(sessionmaker(bind=database_engine), batch_size=50, max_delay=60)
+    repo = SqlAlchemyRepository(sessionmaker(bind=database_engine), review_writer=writer)
+    repo.add_review(Review('kurisu', 'Split', None, None, None, 'Unsettling', 8))
+
+    # Flushing for a user with nothing queued leaves the queue alone.
+    repo.flush_reviews('okabe')
+    assert len(writer) == 1
+    repo.flush_reviews('kurisu')
+    assert len(writer) == 0
+    repo.reset_session()
+    assert [review.user for review in repo.get_review()] == ['kurisu']
+
+    repo.add_review(Review('okabe', 'Split', None, None, None, 'Tense', 7))
+    writer.close()
+    assert writer.reviews_written == 2 and writer.batches_written == 2
+    repo.reset_session()
+    assert len(repo.get_review()) == 2
+    with pytest.raises(RuntimeError):
+        writer.add(Review('okabe', 'Sing', None, None, None, 'Catchy', 6))
+
+
+def test_write_behind_drops_a_review_the_database_keeps_rejecting(database_engine, capsys):
+    writer = ReviewWriteBehind(sessionmaker(bind=database_engine), batch_size=50, max_delay=60, max_attempts=2)
+    writer.add(Review('kurisu', 'Split', None, None, None, 'Unsettling', 8))
+    writer.add(Review(None, 'Split', None, None, None, 'No user', 1))
+    writer.add(Review('okabe', 'Sing', None, None, None, 'Catchy', 6))
+
+    with pytest.raises(IntegrityError):
+        writer.flush('kurisu')
+    assert len(writer) == 3
+    # The last attempt writes the reviews one by one, keeping those the database accepts.
+    assert writer.flush('kurisu') == 2
+    assert len(writer) == 0 and writer.reviews_dropped == 1
+    assert 'DROPPED A REVIEW BY None' in capsys.readouterr().out
+    writer.close()
+
+    repo = SqlAlchemyRepository(sessionmaker(bind=database_engine))
+    assert [review.review_text for review in repo.get_review()] == ['Unsettling', 'Catchy']
+    assert repo.get_review_aggregate('movie', 'Split').review_count == 1
+
+
+def test_write_behind_flushes_when_a_review_has_waited_long_enough(database_engine):
+    writer = ReviewWriteBehind(sessionmaker(bind=database_engine), batch_size=50, max_delay=0.05)
+    try:
+        writer.add(Review('kurisu', 'Split', None, None, None, 'Unsettling', 8))
+        deadline = time.monotonic() + 5
+        while writer.reviews_written == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert writer.reviews_written == 1 and len(writer) == 0
+    finally:
+        writer.close()
+
+
+def test_repository_updates_review_aggregates_with_the_review(session_factory):
+    repo = SqlAlchemyRepository(session_factory)
+    repo.add_review(Review('kurisu', None, 'Ridley Scott', None, None, 'Great', 8))
+    repo.add_review(Review('okabe', None, 'Ridley Scott', None, None, 'Fine', 5))
+
+    aggregate = repo.get_review_aggregate('director', 'Ridley Scott')
+    assert (aggregate.rating_sum, aggregate.rating_count, aggregate.rating_mean) == (13, 2, 6.5)
+    assert aggregate.review_count == 2
+    assert aggregate.last_reviewed == repo.get_review()[-1].time_stamp
+
+    # A review that fails to insert leaves the aggregate as it was.
+    with pytest.raises(IntegrityError):
+        repo.add_review(Review(None, None, 'Ridley Scott', None, None, 'No user', 1))
+    repo.reset_session()
+    assert repo.get_review_aggregate('director', 'Ridley Scott').rating_count == 2
+    assert repo.get_review_aggregate('director', 'James Gunn') is None
+    aggregates = repo.get_review_aggregates('director', ['Ridley Scott', 'James Gunn'])
+    assert list(aggregates) == ['Ridley Scott'] and aggregates['Ridley Scott'].review_count == 2
+    assert repo.get_review_aggregates('director', []) == {}
+
+
+def test_repository_finds_reviews_by_user_and_movie(session_factory):
+    repo = SqlAlchemyRepository(session_factory)
+    for user, title, text in (('kurisu', 'Split', 'Tense'), ('okabe', 'Split', 'Long'), ('kurisu', None, 'Actor'),
+                              ('kurisu', 'Sing', 'Fun'), ('kurisu', 'Split', 'Again')):
+        repo.add_review(Review(user, title, None, None, None if title else 'Noomi Rapace', text, 7))
+
+    def texts(**kwargs):
+        reviews, total = repo.find_reviews(**kwargs)
+        return [review.review_text for review in reviews], total
+
+    assert texts(user='kurisu', offset=1, limit=2) == (['Actor', 'Fun'], 4)
+    assert texts(movie='Split') == (['Tense', 'Long', 'Again'], 3)
+    assert texts(user='kurisu', movie='Split') == (['Tense', 'Again'], 2)
+    assert texts(limit=1) == (['Tense'], 5)
+    assert texts(user='kurisu', offset=9) == ([], 4)
+    assert texts(user='mayuri') == ([], 0)
+
+
+def test_repository_lists_the_top_rated(session_factory):
+    repo = SqlAlchemyRepository(session_factory)
+    for title, rating in (('Split', 6), ('Sing', 9), ('Prometheus', 9), ('Split', 8)):
+        repo.add_review(Review('kurisu', title, None, None, None, 'Review', rating))
+
+    top_rated = repo.get_top_rated('movie', limit=2)
+    assert [(aggregate.key, aggregate.rating_mean) for aggregate in top_rated] == [('Prometheus', 9), ('Sing', 9)]
+    assert repo.get_top_rated('movie')[-1].rating_mean == 7
+    assert repo.get_top_rated('genre') == []
+
+
+def test_write_behind_batch_updates_review_aggregates(database_engine):
+    writer = ReviewWriteBehind(sessionmaker(bind=database_engine), batch_size=50, max_delay=60)
+    for rating in (4, 6, 8):
+        writer.add(Review('kurisu', None, None, 'Comedy', None, 'Funny', rating))
+    writer.close()
+
+    repo = SqlAlchemyRepository(sessionmaker(bind=database_engine))
+    aggregate = repo.get_review_aggregate('genre', 'Comedy')
+    assert (aggregate.rating_sum, aggregate.rating_count, aggregate.rating_mean) == (18, 3, 6)
+
+
+def test_review_aggregates_can_be_rebuilt_from_the_reviews(database_engine):
+    repo = SqlAlchemyRepository(sessionmaker(bind=database_engine))
+    repo.add_review(Review('kurisu', 'Split', None, None, None, 'Unsettling', 8))
+    repo.add_review(Review('okabe', 'Split', None, None, None, 'No rating', 11))
+    repo.add_review(Review('okabe', None, None, None, 'Matt Damon', 'Steady', 7))
+    rows = sorted(database_engine.execute(orm.review_aggregates.select()))
+
+    database_repository.rebuild_review_aggregates(database_engine)
+    assert sorted(database_engine.execute(orm.review_aggregates.select())) == rows
+    assert [row[:6] for row in rows] == [('actor', 'Matt Damon', 7, 1, 7.0, 1), ('movie', 'Split', 8, 1, 8.0, 2)]
+
+
+def test_repository_searches_titles_descriptions_and_reviews(session_factory):
+    repo = SqlAlchemyRepository(session_factory)
+    movies, movie_count = repo.search_movies('great wall', load=MOVIE_LISTING)
+    assert movie_count == 1 and movies[0].title == 'The Great Wall'
+    assert repo.search_movies('"wall great"') == ([], 0)
+    assert repo.search_movies('"') == ([], 0)
+
+    movies, movie_count = repo.search_movies('a', offset=1, limit=2)
+    assert movie_count > 3 and len(movies) == 2
+    assert repo.search_movies('a', offset=100) == ([], movie_count)
+
+    repo.add_review(Review('kurisu', 'Sing', None, None, None, 'Wonderful soundtrack', 9))
+    repo.add_movie(1, 'Guardians of the Galaxy', 2014, 'A group of intergalactic criminals', 'James Gunn',
+                   'Chris Pratt', 'Action', 121, 8.1, 333.13, 76, 757074)
+    assert [movie.title for movie in repo.search_movies('SOUNDTRACK')[0]] == ['Sing']
+    assert [movie.title for movie in repo.search_movies('intergalactic')[0]] == ['Guardians of the Galaxy']
+
+
+def test_repository_search_ranks_like_the_memory_repository(session_factory):
+    repo = SqlAlchemyRepository(session_factory)
+    memory_repo = MemoryRepository()
+    read_csv_file(TEST_DATA_PATH_DATABASE, memory_repo)
+    for title, text in (('Split', 'The mercenaries of horror'), ('Sing', 'A city of song')):
+        repo.add_review(Review('kurisu', title, None, None, None, text, 7))
+        memory_repo.add_review(Review('kurisu', title, None, None, None, text, 7))
+
+    for query in ('a', 'the', 'city', 'of the', 'mercenaries', '"a team"', 'theater singing'):
+        assert [movie.id for movie in repo.search_movies(query)[0]] == \
+               [movie.id for movie in memory_repo.search_movies(query)[0]], query
+
+
+def test_repository_completes_names_by_prefix_from_an_index(session_factory):
+    repo = SqlAlchemyRepository(session_factory)
+    assert repo.get_names_starting_with('genre', 'a') == ['Action', 'Adventure', 'Animation']
+    assert repo.get_names_starting_with('genre', 'A', limit=2) == ['Action', 'Adventure']
+    assert repo.get_names_starting_with('director', 'RIDLEY') == ['Ridley Scott']
+    assert repo.get_names_starting_with('actor', 'zz') == []
+
+    # LIKE wildcards in the prefix are matched literally.
+    repo.add_genre(Genre('Sci_Fi 100%'))
+    assert repo.get_names_starting_with('genre', 'sci_') == ['Sci_Fi 100%']
+    assert repo.get_names_starting_with('genre', 'sci-') == ['Sci-Fi']
+    assert repo.get_names_starting_with('genre', '%') == []
+    with pytest.raises(ValueError):
+        repo.get_names_starting_with('movie', 'a')
+
+    plan = session_factory().execute('EXPLAIN QUERY PLAN ' + str(database_repository.NAMES_STARTING_WITH['actor']),
+                                     {'pattern': 'ma%', 'limit': 10}).fetchall()
+    assert 'USING COVERING INDEX ix_actors_actor_full_name_nocase' in plan[0][-1]
+    assert not any('TEMP B-TREE' in row[-1] for row in plan)
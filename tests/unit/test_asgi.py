@@ -0,0 +1,80 @@
+import asyncio
+import threading
+import time
+
+from movie_web_app.asgi import AsgiAdapter, wsgi_environ
+
+
+def call(app, method='GET', path='/', query_string=b'', headers=(), body=b''):
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query_string,
+             'headers': list(headers), 'http_version': '1.1', 'scheme': 'http', 'server': ('testserver', 80)}
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    async def run():
+        await app(scope, receive, send)
+        return sent
+
+    return run()
+
+
+def test_environ_is_built_from_the_scope():
+    scope = {'type': 'http', 'method': 'POST', 'path': '/comment', 'query_string': b'title=Split',
+             'headers': [(b'content-type', b'text/plain'), (b'cookie', b'a=1'), (b'cookie', b'b=2'),
+                         (b'accept', b'text/html'), (b'accept', b'*/*')],
+             'server': ('localhost', 8000), 'client': ('10.0.0.1', 5000)}
+    environ = wsgi_environ(scope, b'Hello')
+
+    assert environ['REQUEST_METHOD'] == 'POST'
+    assert environ['PATH_INFO'] == '/comment'
+    assert environ['QUERY_STRING'] == 'title=Split'
+    assert environ['CONTENT_TYPE'] == 'text/plain'
+    assert environ['HTTP_COOKIE'] == 'a=1; b=2'
+    assert environ['HTTP_ACCEPT'] == 'text/html, */*'
+    assert environ['SERVER_PORT'] == '8000'
+    assert environ['REMOTE_ADDR'] == '10.0.0.1'
+    assert environ['wsgi.input'].read() == b'Hello'
+
+
+def test_streamed_response_is_sent_chunk_by_chunk():
+    def wsgi_app(environ, start_response):
+        start_response('201 Created', [('Content-Type', 'text/plain')])
+        return iter([b'one', b'', b'two'])
+
+    sent = asyncio.run(call(AsgiAdapter(wsgi_app)))
+
+    assert sent[0] == {'type': 'http.response.start', 'status': 201, 'headers': [(b'content-type', b'text/plain')]}
+    assert [message['body'] for message in sent[1:]] == [b'one', b'two', b'']
+    assert sent[-1]['more_body'] is False
+
+
+def test_many_requests_in_flight_share_a_bounded_pool_of_threads():
+    running = []
+    most_running = []
+    lock = threading.Lock()
+
+    def wsgi_app(environ, start_response):
+        with lock:
+            running.append(environ['QUERY_STRING'])
+            most_running.append(len(running))
+        time.sleep(0.01)
+        with lock:
+            running.remove(environ['QUERY_STRING'])
+        start_response('200 OK', [])
+        return [environ['QUERY_STRING'].encode('latin-1')]
+
+    adapter = AsgiAdapter(wsgi_app, max_workers=4)
+
+    async def run_all():
+        return await asyncio.gather(*[call(adapter, query_string=str(i).encode()) for i in range(200)])
+
+    responses = asyncio.run(run_all())
+
+    assert [sent[1]['body'] for sent in responses] == [str(i).encode() for i in range(200)]
+    assert max(most_running) <= 4
@@ -98,3 +98,15 @@ def test_genre_construction(genre):
     assert genre.genre_name == 'Idol'
     assert repr(genre) == '<Idol>'
 
+
+
+def test_unreviewed_entities_share_an_empty_review_collection(actor, director, genre):
+    assert actor.review is director.review is genre.review
+    assert len(actor.review) == 0
+
+
+def test_add_review_creates_the_review_collection(actor, genre, review2):
+    actor.add_review(review2)
+
+    assert actor.review == [review2]
+    assert len(genre.review) == 0
@@ -0,0 +1,22 @@
+from movie_web_app.movies.fragment_cache import FragmentCache
+
+
+def test_fragment_cache_evicts_the_least_recently_used_fragment():
+    cache = FragmentCache(max_entries=2)
+    cache.put((2, 0), 'card 2')
+    cache.put((3, 0), 'card 3')
+    assert cache.get((2, 0)) == 'card 2'
+    cache.put((4, 0), 'card 4')
+
+    assert cache.get((3, 0)) is None
+    assert cache.get((2, 0)) == 'card 2' and cache.get((4, 0)) == 'card 4'
+    assert cache.stats() == {'entries': 2, 'hits': 3, 'misses': 1, 'evictions': 1}
+
+
+def test_fragment_cache_keeps_each_version_under_its_own_key():
+    cache = FragmentCache()
+    cache.put((2, 0), 'card without reviews')
+    cache.put((2, 1), 'card with a review')
+    assert cache.get((2, 1)) == 'card with a review'
+    assert cache.get((2, 0)) == 'card without reviews'
+    assert len(cache) == 2
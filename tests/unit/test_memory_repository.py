@@ -1,9 +1,13 @@
+import os
+import threading
 from datetime import date, datetime
 from typing import List
 
 import pytest
 
 from movie_web_app.domain.model import Movie, Actor, Director, Genre, Review, User
+from movie_web_app.adapters.memory_repository import MemoryRepository, load_movies
+from tests.conftest import TEST_DATA_PATH_MEMORY
 
 
 def test_repository_can_add_a_user(in_memory_repo):
@@ -93,3 +97,229 @@ def test_repository_does_not_retrieve_a_non_existent_genre(in_memory_repo):
 
 
 
+
+
+def test_repository_does_not_add_a_duplicate_actor(in_memory_repo):
+    actor = in_memory_repo.get_actor("Noomi Rapace")
+    in_memory_repo.add_actor(Actor("Noomi Rapace"))
+
+    assert in_memory_repo.get_actor("Noomi Rapace") is actor
+    assert len([a for a in in_memory_repo.dataset_of_actors if a.actor_full_name == "Noomi Rapace"]) == 1
+
+
+def test_repository_retrieves_user_case_insensitively(in_memory_repo):
+    user = User('Mayuri', '123456789')
+    in_memory_repo.add_user(user)
+
+    assert in_memory_repo.get_user('MAYURI') is user
+
+
+def test_repository_can_retrieve_movie_ids_by_genres(in_memory_repo):
+    assert in_memory_repo.find_movie_ids(genres=['Action', 'Adventure']) == ([5, 6], 2)
+    assert in_memory_repo.find_movie_ids(genres=['Action', 'Adventure', 'Fantasy']) == ([5, 6], 2)
+    assert in_memory_repo.find_movie_ids(genres=['Comedy']) == ([4, 7, 8], 3)
+
+
+def test_repository_can_retrieve_movie_ids_by_actors_and_director(in_memory_repo):
+    assert in_memory_repo.find_movie_ids(actors=['Noomi Rapace', 'Logan Marshall-Green']) == ([2], 1)
+    assert in_memory_repo.find_movie_ids(director='Ridley Scott') == ([2], 1)
+    assert in_memory_repo.find_movie_ids(actors=['Noomi Rapace'], genres=['Comedy']) == ([], 0)
+
+
+def test_repository_does_not_retrieve_movie_ids_for_a_non_existent_name(in_memory_repo):
+    assert in_memory_repo.find_movie_ids(actors=['Noomi Rapace', 'Moeka Kiriyu']) == ([], 0)
+
+
+def test_repository_can_retrieve_movies_by_ids(in_memory_repo):
+    movies = in_memory_repo.get_movies_by_ids([7, 2, 100])
+
+    assert [movie.title for movie in movies] == ['La La Land', 'Prometheus']
+
+
+def test_repository_can_retrieve_a_page_of_movies(in_memory_repo):
+    movies, movie_count = in_memory_repo.find_movies(offset=2, limit=3)
+
+    assert movie_count == 7
+    assert [movie.id for movie in movies] == [4, 5, 6]
+
+
+def test_repository_can_retrieve_a_filtered_page_of_movies(in_memory_repo):
+    movies, movie_count = in_memory_repo.find_movies(genres=['Comedy'], offset=1, limit=6)
+
+    assert movie_count == 3
+    assert [movie.title for movie in movies] == ['La La Land', 'Mindhorn']
+
+
+
+def test_repository_finds_only_the_ids_of_a_page_of_movies(in_memory_repo):
+    assert in_memory_repo.find_movie_ids(offset=2, limit=3) == ([4, 5, 6], 7)
+    assert in_memory_repo.find_movie_ids(genres=['Comedy'], offset=1, limit=1) == ([7], 3)
+    assert in_memory_repo.find_movie_ids(genres=['Comedy'], offset=10) == ([], 3)
+    assert list(in_memory_repo.iter_movie_ids(offset=5)) == [7, 8]
+    assert list(in_memory_repo.iter_movie_ids(genres=['Comedy'], director='Damien Chazelle')) == [7]
+
+
+def test_repository_finds_movies_with_all_of_the_given_names(in_memory_repo):
+    movies, movie_count = in_memory_repo.find_movies(genres=['Action', 'Adventure'], actors=['Matt Damon', 'Matt Damon'])
+    assert movie_count == 1
+    assert [movie.title for movie in movies] == ['The Great Wall']
+
+    movies, movie_count = in_memory_repo.find_movies(genres=['Comedy'], director='Damien Chazelle')
+    assert movie_count == 1
+    assert [movie.title for movie in movies] == ['La La Land']
+
+    assert in_memory_repo.find_movies(genres=['Action', 'Western']) == ([], 0)
+    assert in_memory_repo.find_movies(genres=['Comedy'], offset=10, limit=6) == ([], 3)
+
+
+def test_repository_movies_share_actor_genre_and_director_objects(in_memory_repo):
+    suicide_squad = in_memory_repo.get_movie('Suicide Squad')
+    great_wall = in_memory_repo.get_movie('The Great Wall')
+
+    assert suicide_squad.genres[0] is great_wall.genres[0] is in_memory_repo.get_genre('Action')
+    assert in_memory_repo.get_movie('Prometheus').director[0] is in_memory_repo.get_director('Ridley Scott')
+    assert in_memory_repo.get_movie('Prometheus').actors[0] is in_memory_repo.get_actor('Noomi Rapace')
+
+
+def test_repository_registers_people_of_an_added_movie(in_memory_repo):
+    in_memory_repo.add_movie(1, 'Guardians of the Galaxy', 2014, '', 'James Gunn',
+                             'Chris Pratt, Vin Diesel', 'Action,Sci-Fi', 121, 8.1, 333.13, 76, 757074)
+
+    movie = in_memory_repo.get_movie('Guardians of the Galaxy')
+    assert in_memory_repo.get_actor('Chris Pratt') is movie.actors[0]
+    assert in_memory_repo.get_director('James Gunn') is movie.director[0]
+    assert in_memory_repo.get_genre('Action') is movie.genres[0]
+
+
+def test_repository_can_filter_movie_ids_by_value_ranges(in_memory_repo):
+    assert in_memory_repo.get_movie_ids_by_values({'time': (2016, 2016), 'rating': (7.2, None)}) == [3, 4, 7]
+    assert in_memory_repo.get_movie_ids_by_values({'revenue': (0, None)}) == [2, 3, 4, 5, 6, 7]
+
+
+def test_repository_can_retrieve_top_movie_ids_by_value(in_memory_repo):
+    assert in_memory_repo.get_movie_ids_by_values(order_by='rating', descending=True, limit=2) == [7, 3]
+    assert in_memory_repo.get_movie_ids_by_values(order_by='revenue', descending=True) == [5, 4, 7, 3, 2, 6, 8]
+
+
+def test_load_movies_writes_and_reuses_a_snapshot(tmp_path):
+    snapshot_path = str(tmp_path / 'movies.snapshot')
+
+    repo = MemoryRepository()
+    load_movies(TEST_DATA_PATH_MEMORY, repo, snapshot_path)
+    assert os.path.exists(snapshot_path)
+
+    repo_from_snapshot = MemoryRepository()
+    load_movies(TEST_DATA_PATH_MEMORY, repo_from_snapshot, snapshot_path)
+    assert repo_from_snapshot.get_dataset_of_movies() == repo.get_dataset_of_movies()
+    assert repo_from_snapshot.find_movie_ids(actors=['Noomi Rapace']) == ([2], 1)
+
+
+def test_load_movies_ignores_a_stale_snapshot(tmp_path):
+    csv_path = tmp_path / 'movies.csv'
+    snapshot_path = str(tmp_path / 'movies.snapshot')
+    with open(TEST_DATA_PATH_MEMORY, encoding='utf-8-sig') as infile:
+        lines = infile.readlines()
+    csv_path.write_text(''.join(lines[:3]), encoding='utf-8')
+    load_movies(str(csv_path), MemoryRepository(), snapshot_path)
+
+    csv_path.write_text(''.join(lines), encoding='utf-8')
+    repo = MemoryRepository()
+    load_movies(str(csv_path), repo, snapshot_path)
+    assert len(repo.get_dataset_of_movies()) == 7
+
+
+def test_repository_adds_reviews_to_what_they_review_and_aggregates_ratings(in_memory_repo):
+    in_memory_repo.add_review(Review('kurisu', None, None, None, 'Noomi Rapace', 'Great', 8))
+    in_memory_repo.add_review(Review('okabe', None, None, None, 'Noomi Rapace', 'Fine', 5))
+    in_memory_repo.add_review(Review('okabe', None, None, None, 'Noomi Rapace', 'No rating', 11))
+
+    assert len(in_memory_repo.get_actor('Noomi Rapace').review) == 3
+    aggregate = in_memory_repo.get_review_aggregate('actor', 'Noomi Rapace')
+    assert (aggregate.rating_sum, aggregate.rating_count, aggregate.rating_mean) == (13, 2, 6.5)
+    assert aggregate.review_count == 3
+    assert aggregate.last_reviewed == in_memory_repo.get_review()[-1].time_stamp
+    assert in_memory_repo.get_review_aggregate('actor', 'Matt Damon') is None
+    assert list(in_memory_repo.get_review_aggregates('actor', {'Noomi Rapace', 'Matt Damon'})) == ['Noomi Rapace']
+
+
+def test_repository_finds_reviews_by_user_and_movie(in_memory_repo):
+    for user, title, text in (('kurisu', 'Split', 'Tense'), ('okabe', 'Split', 'Long'), ('kurisu', None, 'Actor'),
+                              ('kurisu', 'Sing', 'Fun'), ('kurisu', 'Split', 'Again')):
+        in_memory_repo.add_review(Review(user, title, None, None, None if title else 'Noomi Rapace', text, 7))
+
+    def texts(**kwargs):
+        reviews, total = in_memory_repo.find_reviews(**kwargs)
+        return [review.review_text for review in reviews], total
+
+    assert texts(user='kurisu', offset=1, limit=2) == (['Actor', 'Fun'], 4)
+    assert texts(movie='Split') == (['Tense', 'Long', 'Again'], 3)
+    assert texts(user='kurisu', movie='Split') == (['Tense', 'Again'], 2)
+    assert texts(limit=1) == (['Tense'], 5)
+    assert texts(user='kurisu', offset=9) == ([], 4)
+    assert texts(user='mayuri') == ([], 0)
+
+
+def test_repository_lists_the_top_rated(in_memory_repo):
+    for title, rating in (('Split', 6), ('Sing', 9), ('Prometheus', 9), ('Split', 8)):
+        in_memory_repo.add_review(Review('kurisu', title, None, None, None, 'Review', rating))
+
+    top_rated = in_memory_repo.get_top_rated('movie', limit=2)
+    assert [(aggregate.key, aggregate.rating_mean) for aggregate in top_rated] == [('Prometheus', 9), ('Sing', 9)]
+    assert in_memory_repo.get_top_rated('actor') == []
+
+
+def test_repository_searches_titles_descriptions_and_reviews(in_memory_repo):
+    movies, movie_count = in_memory_repo.search_movies('great wall')
+    assert movie_count == 1 and movies[0].title == 'The Great Wall'
+    assert in_memory_repo.search_movies('"wall great"') == ([], 0)
+
+    movies, movie_count = in_memory_repo.search_movies('a', offset=1, limit=2)
+    assert movie_count > 3 and len(movies) == 2
+
+    # The index picks up reviews added after it was built.
+    in_memory_repo.add_review(Review('kurisu', 'Sing', None, None, None, 'Wonderful soundtrack', 9))
+    movies, movie_count = in_memory_repo.search_movies('SOUNDTRACK')
+    assert [movie.title for movie in movies] == ['Sing']
+
+
+def test_repository_finds_a_review_under_every_movie_with_its_title(in_memory_repo):
+    in_memory_repo.add_movie(1, 'Sing', 2001, 'A remake', 'Garth Jennings', 'Reese Witherspoon', 'Comedy',
+                             110, 6.0, 'N/A', 'N/A', 1000)
+    in_memory_repo.add_review(Review('kurisu', 'Sing', None, None, None, 'Wonderful soundtrack', 9))
+    movies, movie_count = in_memory_repo.search_movies('soundtrack')
+    assert sorted(movie.id for movie in movies) == [1, 4]
+
+    # Also once the index is built.
+    in_memory_repo.add_review(Review('kurisu', 'Sing', None, None, None, 'Catchy', 8))
+    movies, movie_count = in_memory_repo.search_movies('catchy')
+    assert sorted(movie.id for movie in movies) == [1, 4]
+
+
+def test_repository_builds_the_search_index_once_for_concurrent_searches(in_memory_repo):
+    barrier = threading.Barrier(8)
+    results = []
+
+    def search():
+        barrier.wait()
+        results.append(in_memory_repo.search_movies('a')[1])
+
+    threads = [threading.Thread(target=search) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # No search saw a partly built index.
+    assert len(set(results)) == 1 and results[0] > 3
+
+
+def test_repository_completes_names_by_prefix(in_memory_repo):
+    assert in_memory_repo.get_names_starting_with('genre', 'a') == ['Action', 'Adventure', 'Animation']
+    assert in_memory_repo.get_names_starting_with('genre', 'A', limit=2) == ['Action', 'Adventure']
+    assert in_memory_repo.get_names_starting_with('director', 'RIDLEY') == ['Ridley Scott']
+    assert in_memory_repo.get_names_starting_with('actor', 'zz') == []
+
+    # Names added after the first completion are kept in order.
+    in_memory_repo.add_genre(Genre('Adult'))
+    assert in_memory_repo.get_names_starting_with('genre', 'ad') == ['Adult', 'Adventure']
+    with pytest.raises(ValueError):
+        in_memory_repo.get_names_starting_with('movie', 'a')
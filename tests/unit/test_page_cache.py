@@ -0,0 +1,36 @@
+from movie_web_app.movies.page_cache import PageCache
+
+
+def test_page_cache_evicts_the_least_recently_used_page():
+    cache = PageCache(max_entries=2)
+    cache.put('a', 'page a', {'Split'}, cache.generation)
+    cache.put('b', 'page b', {'Sing'}, cache.generation)
+    assert cache.get('a') == 'page a'
+    cache.put('c', 'page c', {'Sing'}, cache.generation)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 'page a' and cache.get('c') == 'page c'
+    assert cache.stats() == {'entries': 2, 'hits': 3, 'misses': 1, 'evictions': 1, 'invalidations': 0}
+
+
+def test_page_cache_drops_only_the_pages_showing_a_reviewed_movie():
+    cache = PageCache()
+    cache.put('first page', 'page 1', {'Split', 'Sing'}, cache.generation)
+    cache.put('second page', 'page 2', {'Prometheus'}, cache.generation)
+
+    cache.invalidate_titles({'Sing'})
+    assert cache.get('first page') is None
+    assert cache.get('second page') == 'page 2'
+    assert cache.stats()['invalidations'] == 1
+
+
+def test_page_cache_does_not_store_a_page_rendered_before_an_invalidation():
+    cache = PageCache()
+    generation = cache.generation
+    # A review lands while the page is being rendered from the data read before it.
+    cache.invalidate_titles({'Split'})
+    cache.put('page', 'stale page', {'Split'}, generation)
+    assert cache.get('page') is None
+
+    cache.put('page', 'fresh page', {'Split'}, cache.generation)
+    assert cache.get('page') == 'fresh page'
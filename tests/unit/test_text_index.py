@@ -0,0 +1,38 @@
+from movie_web_app.adapters.text_index import MovieTextIndex, parse_query, tokenize
+
+
+def test_tokenize_folds_case_and_accents_and_splits_on_punctuation():
+    assert tokenize("Amélie's CAFÉ, snake_case 2049") == ['amelie', 's', 'cafe', 'snake', 'case', '2049']
+
+
+def test_parse_query_makes_phrases_of_quoted_text_and_hyphenated_words():
+    assert parse_query('jazz "Los Angeles" spider-man "" !') == [('jazz',), ('los', 'angeles'), ('spider', 'man')]
+    assert parse_query('   ') == []
+
+
+def test_index_matches_phrases_only_when_their_words_are_adjacent():
+    index = MovieTextIndex()
+    index.add(1, 'description', 'A jazz pianist falls for an aspiring actress in Los Angeles.')
+    index.add(2, 'description', 'Los Alamos scientists play jazz in Angeles National Forest.')
+
+    assert index.search(parse_query('"los angeles"')) == [1]
+    assert sorted(index.search(parse_query('los angeles'))) == [1, 2]
+    assert index.search(parse_query('jazz trumpet')) == []
+
+
+def test_index_ranks_title_matches_first_and_appends_reviews():
+    index = MovieTextIndex()
+    index.add(1, 'title', 'Moon')
+    index.add(1, 'description', 'An astronaut nears the end of his stint.')
+    index.add(2, 'title', 'Prometheus')
+    index.add(2, 'description', 'A team finds a structure on a distant moon.')
+    index.add(3, 'title', 'Sing')
+    index.add(3, 'description', 'Animals hold a singing competition.')
+
+    assert index.search(parse_query('moon')) == [1, 2]
+
+    index.add(3, 'reviews', 'Over the moon')
+    index.add(3, 'reviews', 'Catchy songs')
+    assert index.search(parse_query('moon')) == [1, 3, 2]
+    # Reviews are appended one after another, so a phrase can span the end of one and the start of the next.
+    assert index.search(parse_query('"moon catchy"')) == [3]